@@ -0,0 +1,365 @@
+"""
+Per-round update collectors used by the aggregator server.
+
+Each round gets a fresh collector; once the round closes it is handed to the
+aggregation worker, which calls `aggregate(out, global_flat)` to build the next
+global model into a preallocated flat float32 vector laid out by the collector's
+`layout` (see flat_params). Every collector reports the size of the working buffers
+it aggregated with in `working_bytes`.
+"""
+
+import math
+
+import numpy as np
+
+from flat_params import FlatLayout
+from weights_codec import accumulate_tensor, check_tensor, decode_range, decode_tensor
+
+# Parameters per chunk for the robust aggregators: a (clients x chunk) float32 working buffer
+DEFAULT_CHUNK_SIZE = 1 << 20
+
+
+class RunningSumAccumulator:
+    """
+    Folds each client's weights into preallocated per-layer weighted sums as they arrive.
+
+    Only one flat model-sized buffer (plus one scratch buffer for weighted or quantized
+    updates) is held no matter how many clients report, and closing the round is a single
+    division over the whole vector. Delta updates (w - global) are summed as-is; the global model they are based
+    on is added back once, weighted by their total weight, when the round closes.
+    """
+
+    def __init__(self, dtype=np.float64):
+        """
+        Args:
+            dtype: Accumulator precision (float32 or float64)
+        """
+        self.dtype = np.dtype(dtype)
+        self.layout = None
+        self.flat_sums = None
+        self.flat_scratch = None
+        self.client_ids = []
+        self.total_weight = 0.0
+        self.delta_weight = 0.0  # total weight of delta updates
+
+    def __len__(self):
+        return len(self.client_ids)
+
+    def add(self, client_id, model_weights, weight=1.0):
+        """
+        Fold a client's ModelWeights into the running sums, scaled by `weight`.
+
+        Every tensor is checked before the first one is folded in, so a rejected update
+        leaves the sums untouched.
+
+        Returns:
+            False if this client already contributed to the current round (the update is ignored)
+
+        Raises:
+            ValueError: If the update's model layout differs from the round's, or a tensor's
+                        payload does not match its shape
+        """
+        if client_id in self.client_ids:
+            return False
+
+        tensors = model_weights.tensors
+        layout = FlatLayout.from_tensors(tensors)
+        for tensor in tensors:
+            check_tensor(tensor)
+        if self.layout is None:
+            self.layout = layout
+            self.flat_sums = layout.allocate(self.dtype, fill=0.0)
+            self.flat_scratch = layout.allocate(self.dtype)
+        elif layout != self.layout:
+            raise ValueError(f"Client '{client_id}' sent weights with a different model layout")
+
+        sums, scratch = self.layout.views(self.flat_sums), self.layout.views(self.flat_scratch)
+        for layer_sum, layer_scratch, tensor in zip(sums, scratch, tensors):
+            # Works straight from the (read-only) wire view, no per-client copy
+            accumulate_tensor(tensor, layer_sum, weight, layer_scratch)
+        self.client_ids.append(client_id)
+        self.total_weight += weight
+        if model_weights.is_delta:
+            self.delta_weight += weight
+        return True
+
+    @property
+    def working_bytes(self):
+        return self.flat_sums.nbytes + self.flat_scratch.nbytes if self.layout is not None else 0
+
+    def aggregate(self, out, global_flat=None):
+        """Divide the running sums by the total weight into the flat float32 vector `out`"""
+        if self.delta_weight:
+            np.multiply(global_flat, self.delta_weight, out=self.flat_scratch)
+            np.add(self.flat_sums, self.flat_scratch, out=self.flat_sums)
+        np.divide(self.flat_sums, self.total_weight, out=out)
+        return out
+
+
+class BufferedUpdates:
+    """
+    Keeps every client's ModelWeights until the round closes.
+
+    A second upload from the same client within a round replaces the first one.
+    """
+
+    def __init__(self):
+        self.messages = {}  # {client_id: ModelWeights}
+        self.weights = {}  # {client_id: aggregation weight}
+        self.layout = None  # flat layout of the model being aggregated, set by the first update
+        self.working_bytes = 0
+
+    def __len__(self):
+        return len(self.messages)
+
+    @property
+    def client_ids(self):
+        return list(self.messages)
+
+    def add(self, client_id, model_weights, weight=1.0):
+        """
+        Store a client's ModelWeights and its aggregation weight.
+
+        Returns:
+            True (the update is kept until the round closes)
+
+        Raises:
+            ValueError: If the update's model layout differs from the round's, or a tensor's
+                        payload does not match its shape, so it is rejected now instead of
+                        failing (or being silently truncated in) the aggregation of the round
+        """
+        layout = FlatLayout.from_tensors(model_weights.tensors)
+        for tensor in model_weights.tensors:
+            check_tensor(tensor)
+        if self.layout is None:
+            self.layout = layout
+        elif layout != self.layout:
+            raise ValueError(f"Client '{client_id}' sent weights with a different model layout")
+        self.messages[client_id] = model_weights
+        self.weights[client_id] = weight
+        return True
+
+    def aggregate(self, out, global_flat=None):
+        """
+        Weighted average of the buffered messages into the flat float32 vector `out`.
+
+        The clients' models are copied row by row into one (clients x parameters) matrix
+        and averaged with a single matrix-vector product. Delta updates get the global
+        model added back in proportion to their share of the total weight.
+        """
+        client_ids = list(self.messages)
+        coefficients = np.array([self.weights[c] for c in client_ids], dtype=np.float32)
+        coefficients /= coefficients.sum()
+        delta_share = float(sum(coef for coef, c in zip(coefficients, client_ids) if self.messages[c].is_delta))
+        layout = self.layout
+        stacked = np.empty((len(client_ids), layout.size), dtype=np.float32)
+        self.working_bytes = stacked.nbytes
+        for row, c in zip(stacked, client_ids):
+            for row_layer, tensor in zip(layout.views(row), self.messages[c].tensors):
+                if tensor.sparse:
+                    # Scatter straight into the row instead of densifying the update first
+                    row_layer.fill(0.0)
+                    accumulate_tensor(tensor, row_layer)
+                else:
+                    # Zero-copy view for raw-encoded tensors, rebuilt array for legacy ones
+                    row_layer[...] = decode_tensor(tensor)
+        np.dot(coefficients, stacked, out=out)
+        if delta_share:
+            out += delta_share * global_flat
+        return out
+
+
+class RobustBufferedUpdates(BufferedUpdates):
+    """
+    Base for coordinate-wise robust statistics over the buffered updates.
+
+    Each layer is processed in chunks of `chunk_size` parameters: the clients' values for
+    a chunk are decoded straight into one reused (clients x chunk) buffer (dequantizing or
+    densifying only that slice) and reduced along the client axis with np.partition, so
+    neither the full (clients x parameters) matrix nor a dense copy of any client's layer
+    is ever resident. Delta updates get the global model added back per chunk first. Client
+    weights are ignored: the statistic is over clients, not examples.
+    """
+
+    def __init__(self, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Args:
+            chunk_size: Parameters reduced at a time
+        """
+        super().__init__()
+        self.chunk_size = chunk_size
+
+    def aggregate(self, out, global_flat=None):
+        """Write the coordinate-wise statistic of the buffered models into the flat float32 vector `out`"""
+        messages = [self.messages[c] for c in self.messages]
+        layout = self.layout
+        chunk_size = min(self.chunk_size, max(int(np.prod(shape)) for shape in layout.shapes))
+        buffer = np.empty((len(messages), chunk_size), dtype=np.float32)
+        self.working_bytes = buffer.nbytes
+        global_layers = layout.views(global_flat) if global_flat is not None else None
+        for layer_idx, layer_out in enumerate(layout.views(out)):
+            flat_out = layer_out.reshape(-1)
+            base = global_layers[layer_idx].reshape(-1) if global_layers is not None else None
+            for start in range(0, flat_out.size, chunk_size):
+                end = min(start + chunk_size, flat_out.size)
+                stacked = buffer[:, :end - start]
+                for row, msg in zip(stacked, messages):
+                    decode_range(msg.tensors[layer_idx], start, end, out=row)
+                    if msg.is_delta:
+                        row += base[start:end]
+                self._reduce(stacked, flat_out[start:end])
+        return out
+
+    def _reduce(self, stacked, out):
+        """Reduce a (clients x chunk) block along the client axis into `out`; may reorder `stacked`"""
+        raise NotImplementedError
+
+
+class CoordinateMedian(RobustBufferedUpdates):
+    """Coordinate-wise median of the clients' models"""
+
+    def _reduce(self, stacked, out):
+        num_clients = stacked.shape[0]
+        mid = num_clients // 2
+        if num_clients % 2:
+            stacked.partition(mid, axis=0)
+            out[...] = stacked[mid]
+        else:
+            stacked.partition((mid - 1, mid), axis=0)
+            np.add(stacked[mid - 1], stacked[mid], out=out)
+            out *= 0.5
+
+
+class TrimmedMean(RobustBufferedUpdates):
+    """Coordinate-wise mean after dropping the `trim_fraction` largest and smallest values"""
+
+    def __init__(self, trim_fraction=0.1, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Args:
+            trim_fraction: Share of clients trimmed from each end, per coordinate
+            chunk_size: Parameters reduced at a time
+        """
+        super().__init__(chunk_size)
+        if not 0 <= trim_fraction < 0.5:
+            raise ValueError(f"trim_fraction must be in [0, 0.5), got {trim_fraction}")
+        self.trim_fraction = trim_fraction
+
+    def _reduce(self, stacked, out):
+        num_clients = stacked.shape[0]
+        # Always keep at least one value per coordinate
+        trim = min(int(self.trim_fraction * num_clients), (num_clients - 1) // 2)
+        if trim:
+            stacked.partition((trim, num_clients - trim - 1), axis=0)
+        np.mean(stacked[trim:num_clients - trim], axis=0, out=out)
+
+
+STALENESS_FUNCTIONS = ('constant', 'polynomial', 'hinge')
+
+
+def make_staleness_function(name='polynomial', alpha=0.5, hinge=4):
+    """
+    Build the staleness discount s(tau) used by asynchronous aggregation.
+
+    tau is how many model versions were published since the client's base version.
+        constant:   s(tau) = 1
+        polynomial: s(tau) = (1 + tau) ** -alpha
+        hinge:      s(tau) = 1 for tau <= hinge, else 1 / (alpha * (tau - hinge) + 1)
+    """
+    if name == 'constant':
+        return lambda tau: 1.0
+    if name == 'polynomial':
+        return lambda tau: math.pow(1 + tau, -alpha)
+    if name == 'hinge':
+        return lambda tau: 1.0 if tau <= hinge else 1.0 / (alpha * (tau - hinge) + 1)
+    raise ValueError(f"Unknown staleness function: {name} (expected one of {STALENESS_FUNCTIONS})")
+
+
+class StalenessWeightedBuffer:
+    """
+    FedBuff-style buffer for asynchronous aggregation.
+
+    Each update is turned into a delta against the global model version it was trained
+    from (or used as-is if the client already sent a delta), discounted by s(staleness)
+    and folded into a running sum. Once the buffer holds
+    K updates the aggregation worker applies global + sum / K as the next model version.
+
+    Before any version exists there is nothing to take deltas against, so the first
+    buffer averages full weights instead (bootstrap).
+    """
+
+    def __init__(self, staleness_fn, dtype=np.float64):
+        self.staleness_fn = staleness_fn
+        self.dtype = np.dtype(dtype)
+        self.layout = None
+        self.flat_sums = None
+        self.flat_scratch = None
+        self.client_ids = []
+        self.bootstrap = None  # True while summing full weights instead of deltas
+
+    def __len__(self):
+        return len(self.client_ids)
+
+    def add(self, client_id, model_weights, base_weights=None, staleness=0):
+        """
+        Fold an update into the buffer.
+
+        Args:
+            model_weights: ModelWeights holding the client's trained weights
+            base_weights: Global model the client started from (None while bootstrapping,
+                          not needed for delta updates)
+            staleness: Number of versions published since that base model
+
+        Every tensor is checked before the first one is folded in, so a rejected update
+        leaves the buffer untouched.
+
+        Returns:
+            True (the same client may contribute several times to one buffer)
+
+        Raises:
+            ValueError: If the update's model layout differs from the buffer's, a tensor's
+                        payload does not match its shape, or there is no base to take a delta against
+        """
+        tensors = model_weights.tensors
+        layout = FlatLayout.from_tensors(tensors)
+        for tensor in tensors:
+            check_tensor(tensor)
+        if self.layout is None:
+            self.layout = layout
+            self.flat_sums = layout.allocate(self.dtype, fill=0.0)
+            self.flat_scratch = layout.allocate(self.dtype)
+            self.bootstrap = base_weights is None and not model_weights.is_delta
+        elif layout != self.layout:
+            raise ValueError(f"Client '{client_id}' sent weights with a different model layout")
+        if self.bootstrap and model_weights.is_delta:
+            raise ValueError(f"Delta update from client '{client_id}' but no model version exists yet")
+        if not self.bootstrap and base_weights is None and not model_weights.is_delta:
+            raise ValueError(f"Update from client '{client_id}' has no base model to take a delta against")
+
+        sums, scratch_layers = self.layout.views(self.flat_sums), self.layout.views(self.flat_scratch)
+        if self.bootstrap:
+            for layer_sum, scratch, tensor in zip(sums, scratch_layers, tensors):
+                accumulate_tensor(tensor, layer_sum, 1.0, scratch)
+        elif model_weights.is_delta:
+            weight = self.staleness_fn(staleness)
+            for layer_sum, scratch, tensor in zip(sums, scratch_layers, tensors):
+                accumulate_tensor(tensor, layer_sum, weight, scratch)
+        else:
+            weight = self.staleness_fn(staleness)
+            for layer_sum, scratch, tensor, base in zip(sums, scratch_layers, tensors, base_weights):
+                np.subtract(decode_tensor(tensor), base, out=scratch)
+                np.multiply(scratch, weight, out=scratch)
+                np.add(layer_sum, scratch, out=layer_sum)
+        self.client_ids.append(client_id)
+        return True
+
+    @property
+    def working_bytes(self):
+        return self.flat_sums.nbytes + self.flat_scratch.nbytes if self.layout is not None else 0
+
+    def aggregate(self, out, global_flat=None):
+        """Write the next model version into `out`: global + sum / K, or the plain average when bootstrapping"""
+        np.divide(self.flat_sums, len(self.client_ids), out=self.flat_scratch)
+        if not self.bootstrap:
+            np.add(self.flat_scratch, global_flat, out=self.flat_scratch)
+        out[...] = self.flat_scratch
+        return out
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""
+Federated Learning Aggregator Server - asyncio (grpc.aio) variant
+
+Serves the same SendWeights service as aggregator_server.py, with the same
+configuration, but every RPC is a coroutine on one event loop instead of a thread
+from a 10-worker pool. Idle connections and long-polls (WaitForGlobalModel) cost no
+thread, so one pod can hold thousands of clients. CPU work (parsing completed
+uploads, folding updates into the accumulator, building legacy payloads) is handed
+to a thread pool so it never stalls the loop.
+"""
+
+import asyncio
+import logging
+import os
+from concurrent import futures
+
+import grpc
+from google.protobuf import empty_pb2
+
+import weights_transmitting_pb2
+from aggregator_server import UploadRejected, add_servicer_to_server, servicer_from_env
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class AsyncWeightsAggregatorService:
+    """
+    grpc.aio front end for a WeightsAggregatorService.
+
+    Round bookkeeping, aggregation and the published model cache all stay in the
+    wrapped service; this class only changes how RPCs wait and where CPU work runs.
+    """
+
+    def __init__(self, aggregator, executor_workers=None):
+        """
+        Args:
+            aggregator: WeightsAggregatorService holding the federation state
+            executor_workers: Threads for CPU-bound work (defaults to the CPU count)
+        """
+        self.aggregator = aggregator
+        self.executor = futures.ThreadPoolExecutor(max_workers=executor_workers or os.cpu_count(),
+                                                   thread_name_prefix="aggregator-cpu")
+        self.loop = None
+        self.published = None  # asyncio.Event replaced after every publish
+        self.aggregator.publish_listeners.append(self._on_published)
+
+    async def start(self):
+        """Bind to the running event loop; call before serving"""
+        self.loop = asyncio.get_running_loop()
+        self.published = asyncio.Event()
+
+    def _on_published(self, cache):
+        """Publish listener, called on the aggregation worker thread"""
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self._wake_waiters)
+
+    def _wake_waiters(self):
+        # Waiters hold the old event; the next wait uses a fresh one
+        event, self.published = self.published, asyncio.Event()
+        event.set()
+
+    async def _offload(self, fn, *args):
+        return await self.loop.run_in_executor(self.executor, fn, *args)
+
+    async def TransmitWeights(self, request, context):
+        """Receive weights from a client; the update is folded in on the executor"""
+        try:
+            await self._offload(self.aggregator.receive_update, request)
+        except ValueError as e:
+            await context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(e))
+        return empty_pb2.Empty()
+
+    async def UploadWeights(self, request_iterator, context):
+        """Receive a chunked upload; parsing and folding in the completed message run on the executor"""
+        upload = None
+        async for chunk in request_iterator:
+            try:
+                # Copying a chunk into the preallocated buffer is cheap enough for the loop
+                upload, completed = self.aggregator.write_chunk(chunk)
+                if completed:
+                    await self._offload(self.aggregator.finish_upload, upload)
+            except UploadRejected as e:
+                await context.abort(e.code, str(e))
+            except ValueError as e:
+                await context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(e))
+            if upload.complete:
+                break
+        return self.aggregator.upload_status(upload)
+
+    async def GetUploadStatus(self, request, context):
+        return self.aggregator.GetUploadStatus(request, context)
+
+    async def GetGlobalWeights(self, request, context):
+        """Send the cached global weights (a legacy payload is built on the executor the first time)"""
+        return await self._offload(self.aggregator.GetGlobalWeights, request, None)
+
+    async def WaitForGlobalModel(self, request, context):
+        """
+        Long-poll for the global model of `request.round_number` without holding a thread.
+
+        Same semantics as WeightsAggregatorService.WaitForGlobalModel.
+        """
+        aggregator = self.aggregator
+        timeout = request.timeout_seconds if request.timeout_seconds > 0 else aggregator.max_wait_seconds
+        timeout = min(timeout, aggregator.max_wait_seconds)
+        if context.time_remaining() is not None:
+            timeout = min(timeout, context.time_remaining())
+        deadline = self.loop.time() + timeout
+
+        def is_published():
+            cache = aggregator.global_model_cache
+            return cache is not None and cache.round_number >= request.round_number
+
+        ready = is_published()
+        while not ready:
+            remaining = deadline - self.loop.time()
+            if remaining <= 0:
+                break
+            try:
+                await asyncio.wait_for(self.published.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+            ready = is_published()
+
+        cache = aggregator.global_model_cache
+        if cache is None:
+            logger.warning(f"No global weights published while waiting for round {request.round_number}")
+            return weights_transmitting_pb2.ModelWeights()
+        if not ready:
+            logger.warning(f"Timed out waiting for round {request.round_number}, sending round {cache.round_number}")
+        else:
+            logger.info(f"✓ Sending global weights (round {cache.round_number}) to waiting client")
+        return await self._offload(cache.get, request.tensor_encoding)
+
+    def stop(self):
+        """Stop the executor and the wrapped aggregator's worker"""
+        self.executor.shutdown(wait=True)
+        self.aggregator.stop()
+
+
+async def serve():
+    """Start the grpc.aio server"""
+    aggregator = servicer_from_env()
+    executor_workers = int(os.environ.get('AIO_EXECUTOR_WORKERS', '0')) or None
+    servicer = AsyncWeightsAggregatorService(aggregator, executor_workers)
+    await servicer.start()
+
+    server = grpc.aio.server()
+    add_servicer_to_server(servicer, server)
+    listen_addr = '[::]:50051'
+    server.add_insecure_port(listen_addr)
+
+    logger.info(f"Starting asyncio aggregator server on {listen_addr}")
+    await server.start()
+    try:
+        await server.wait_for_termination()
+    finally:
+        logger.info("Shutting down aggregator server...")
+        await server.stop(0)
+        servicer.stop()
+
+if __name__ == '__main__':
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
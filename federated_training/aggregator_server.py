@@ -7,219 +7,780 @@ import grpc
 from concurrent import futures
 import time
 import logging
-import numpy as np
 import threading
-import pickle
+import queue
 import os
+import socket
 from google.protobuf import empty_pb2
+from google.protobuf.message import DecodeError
 
 import weights_transmitting_pb2
 import weights_transmitting_pb2_grpc
+from weights_codec import convert_weights_to_proto, proto_to_weights
+from flat_params import FlatLayout
+from aggregation import (BufferedUpdates, CoordinateMedian, DEFAULT_CHUNK_SIZE, RunningSumAccumulator,
+                         StalenessWeightedBuffer, TrimmedMean, make_staleness_function)
+from checkpoints import CheckpointStore
+from server_optimizers import make_server_optimizer
+from shared_payload import map_shared_update
+from upstream import UpstreamLink
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Largest serialized update a client may announce; its buffer is allocated up front
+DEFAULT_MAX_UPLOAD_BYTES = 256 * 1024 * 1024
+DEFAULT_SHARED_UPDATES_DIR = '/dataset/updates'
+
+class UploadRejected(Exception):
+    """A chunk that cannot be applied to its upload; `code` is the gRPC status to abort with."""
+
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+
+class PendingUpload:
+    """A chunked upload being reassembled into a preallocated buffer."""
+
+    def __init__(self, upload_id, client_id, total_size):
+        self.upload_id = upload_id
+        self.client_id = client_id
+        self.total_size = total_size
+        self.buffer = bytearray(total_size)
+        self.committed_offset = 0  # bytes received contiguously from the start
+        self.complete = False  # all bytes received
+        self.accepted = None  # outcome once the update was processed: True, or False with `error`
+        self.error = ''
+        self.last_update = time.monotonic()
+
+    def write(self, offset, data):
+        """
+        Copy a chunk into the buffer.
+
+        Chunks that overlap already committed bytes (resent after a reconnect)
+        are trimmed; a chunk starting past the committed offset is a gap and is rejected.
+        Returns False on a gap.
+        """
+        if offset > self.committed_offset:
+            return False
+        end = min(offset + len(data), self.total_size)
+        if end > self.committed_offset:
+            start = self.committed_offset
+            self.buffer[start:end] = memoryview(data)[start - offset:end - offset]
+            self.committed_offset = end
+        self.complete = self.committed_offset == self.total_size
+        self.last_update = time.monotonic()
+        return True
+
+
+class SerializedModelCache:
+    """GetGlobalWeights responses for one published round, serialized once per encoding."""
+
+    def __init__(self, round_number, weights):
+        self.round_number = round_number
+        raw = convert_weights_to_proto(
+            weights, client_id="global", encoding=weights_transmitting_pb2.RAW_BYTES, round_number=round_number
+        )
+        # Built from the weights right away: the model buffer is reused two rounds later
+        self.payloads = {weights_transmitting_pb2.RAW_BYTES: raw.SerializeToString()}
+        self.lock = threading.Lock()
+
+    def get(self, encoding):
+        """Return the serialized response for `encoding`, building it on first use"""
+        payload = self.payloads.get(encoding)
+        if payload is None:
+            with self.lock:
+                payload = self.payloads.get(encoding)
+                if payload is None:
+                    raw = weights_transmitting_pb2.ModelWeights.FromString(
+                        self.payloads[weights_transmitting_pb2.RAW_BYTES]
+                    )
+                    msg = convert_weights_to_proto(
+                        proto_to_weights(raw), client_id="global", encoding=encoding, round_number=self.round_number
+                    )
+                    payload = msg.SerializeToString()
+                    self.payloads[encoding] = payload
+        return payload
+
+
 class WeightsAggregatorService(weights_transmitting_pb2_grpc.SendWeightsServicer):
-    def __init__(self, num_clients=5, min_clients=2):
+    def __init__(self, num_clients=5, min_clients=2, upload_ttl=600,
+                 aggregation_mode='streaming', accumulator_dtype='float64', max_wait_seconds=600,
+                 async_buffer_size=3, staleness_function='polynomial', staleness_alpha=0.5,
+                 staleness_hinge=4, max_staleness=8, round_deadline=0, late_update_policy='drop',
+                 weighting='examples', server_optimizer=None, trim_fraction=0.1,
+                 aggregation_chunk_size=DEFAULT_CHUNK_SIZE, checkpoint_dir='/dataset/checkpoints',
+                 checkpoint_keep=5, upstream=None, max_upload_bytes=DEFAULT_MAX_UPLOAD_BYTES,
+                 shared_updates_dir=DEFAULT_SHARED_UPDATES_DIR):
         """
         Initialize the aggregator service.
         
         Args:
             num_clients: Total expected number of clients
             min_clients: Minimum clients needed before aggregation
+            upload_ttl: Seconds an interrupted chunked upload is kept for resuming
+            aggregation_mode: 'streaming' folds each update into a running sum on arrival,
+                              'buffered' keeps every client's message until the round closes,
+                              'async' publishes a new version every async_buffer_size updates
+                              without waiting for stragglers (FedBuff), 'median' and
+                              'trimmed_mean' buffer the round and take a coordinate-wise
+                              robust statistic instead of the weighted mean
+            accumulator_dtype: Precision of the streaming/async accumulators ('float32' or 'float64')
+            max_wait_seconds: Longest a WaitForGlobalModel call is held open
+            async_buffer_size: Updates (K) per new model version in async mode
+            staleness_function: Async staleness discount ('constant', 'polynomial' or 'hinge')
+            staleness_alpha: Decay rate of the staleness discount
+            staleness_hinge: Staleness up to which the 'hinge' discount is 1
+            max_staleness: Async updates staler than this many versions are dropped
+            round_deadline: Seconds after a round's first update at which it closes with whatever
+                            arrived, provided min_clients (the quorum) reported; 0 disables deadlines
+                            and closes every round as soon as min_clients reported
+            late_update_policy: With deadlines, what to do with an update for an already closed
+                                round: 'drop' it or 'carry' it into the current round
+            weighting: 'examples' weights each sync update by the num_examples it reports
+                       (global = sum(n_i * w_i) / sum(n_i)), 'uniform' gives every client the same weight
+            server_optimizer: ServerOptimizer applied to each round's averaged model (see
+                              make_server_optimizer); None replaces the global model with the average
+            trim_fraction: Share of clients trimmed from each end per coordinate in 'trimmed_mean' mode
+            aggregation_chunk_size: Parameters per chunk for 'median'/'trimmed_mean', bounding
+                                    their working buffer to clients x chunk floats
+            checkpoint_dir: Where each round's global model is checkpointed; the aggregator
+                            resumes from the newest checkpoint found here on startup
+            checkpoint_keep: Number of checkpoints retained (0 keeps all)
+            upstream: UpstreamLink to a root aggregator, making this an edge aggregator: each
+                      closed round's aggregate is forwarded upstream and the root's global
+                      model is published to this edge's clients instead (sync modes only)
+            max_upload_bytes: Largest total_size accepted for a chunked upload
+            shared_updates_dir: Directory of the shared-volume updates; an update's file must be
+                                the client's own `{client_id}_round{N}.npy` in it
         """
+        if aggregation_mode not in ('streaming', 'buffered', 'async', 'median', 'trimmed_mean'):
+            raise ValueError(f"Unknown aggregation mode: {aggregation_mode}")
         self.num_clients = num_clients
         self.min_clients = min_clients
-        self.received_weights = {}  # {client_id: ModelWeights}
-        self.global_weights = None
-        self.round_number = 0
+        self.aggregation_mode = aggregation_mode
+        if upstream is not None and aggregation_mode == 'async':
+            raise ValueError("Edge aggregators need synchronous rounds, async mode cannot forward upstream")
+        self.upstream = upstream
+        self.accumulator_dtype = accumulator_dtype
+        self.async_buffer_size = async_buffer_size
+        self.staleness_fn = make_staleness_function(staleness_function, staleness_alpha, staleness_hinge)
+        self.max_staleness = max_staleness
+        self.model_history = {}  # {round_number: weights}, async mode: recent versions to take deltas against
+        if weighting not in ('examples', 'uniform'):
+            raise ValueError(f"Unknown weighting: {weighting}")
+        self.weighting = weighting
+        self.server_optimizer = server_optimizer
+        self.trim_fraction = trim_fraction
+        self.aggregation_chunk_size = aggregation_chunk_size
+        if late_update_policy not in ('drop', 'carry'):
+            raise ValueError(f"Unknown late update policy: {late_update_policy}")
+        self.round_deadline = round_deadline
+        self.late_update_policy = late_update_policy
+        self.round_timer = None  # deadline timer of the round in progress
+        self.deadline_expired = False
+        self.carried_updates = 0  # late updates carried into the round in progress
+        self.round_examples = 0  # num_examples reported by the updates of the round in progress
+        self.round_updates = self._new_round_updates()  # collector for the round in progress
+        self.global_flat = None  # global model as one flat float32 vector (see flat_params)
+        self.global_weights = None  # per-layer views into global_flat
+        self.global_model_cache = None  # SerializedModelCache of the latest published round
+        self.published = threading.Condition()  # notified whenever a new global model is published
+        self.publish_listeners = []  # callables run with each newly published SerializedModelCache
+        self.max_wait_seconds = max_wait_seconds
+        self.round_number = 0  # round currently collecting updates
         self.lock = threading.Lock()
-        self.weights_output_dir = '/dataset'  # Shared PVC mount
-        logger.info(f"Aggregator initialized: expecting {num_clients} clients, min {min_clients}")
+        # Closed rounds go to a dedicated worker; the global model is double-buffered so the
+        # next one is built while the current one is still being served
+        self.aggregation_queue = queue.Queue()
+        self.model_buffers = [None, None]  # (layout, flat vector) pairs
+        self.front_buffer = 0
+        self.checkpoints = CheckpointStore(checkpoint_dir, checkpoint_keep)  # on the shared PVC
+        self.uploads = {}  # {upload_id: PendingUpload}
+        self.upload_lock = threading.Lock()  # separate from self.lock so uploads don't wait on FedAvg
+        self.upload_ttl = upload_ttl
+        self.max_upload_bytes = max_upload_bytes
+        self.shared_updates_dir = shared_updates_dir
+        self._resume_from_checkpoint()
+        self.aggregation_worker = threading.Thread(
+            target=self._aggregation_loop, name="aggregation-worker", daemon=True
+        )
+        self.aggregation_worker.start()
+        logger.info(f"Aggregator initialized: expecting {num_clients} clients, min {min_clients}, mode {aggregation_mode}")
+    
+    def _resume_from_checkpoint(self):
+        """Reload the newest checkpointed global model and continue with the round after it"""
+        checkpoint = self.checkpoints.load_latest(mmap=False)
+        if checkpoint is None:
+            logger.info(f"No checkpoint in {self.checkpoints.directory}, starting from round 0")
+            return
+        round_number, layout, flat = checkpoint
+        self.model_buffers[self.front_buffer] = (layout, flat)
+        self.global_flat = flat
+        self.global_weights = layout.views(flat)
+        self.round_number = round_number + 1
+        if self.aggregation_mode == 'async':
+            self._remember_version(round_number, layout, flat)
+        self.publish_global_weights(round_number, self.global_weights)
+        logger.info(f"✓ Resumed from checkpoint of round {round_number}, collecting round {self.round_number}")
+    
+    def _new_round_updates(self):
+        if self.aggregation_mode == 'streaming':
+            return RunningSumAccumulator(self.accumulator_dtype)
+        if self.aggregation_mode == 'async':
+            return StalenessWeightedBuffer(self.staleness_fn, self.accumulator_dtype)
+        if self.aggregation_mode == 'median':
+            return CoordinateMedian(self.aggregation_chunk_size)
+        if self.aggregation_mode == 'trimmed_mean':
+            return TrimmedMean(self.trim_fraction, self.aggregation_chunk_size)
+        return BufferedUpdates()
+    
+    def _add_async_update(self, client_id, request):
+        """
+        Fold an update into the async buffer as a staleness-discounted delta. Caller holds self.lock.
+
+        request.round_number is the version the client contributes to, so it was trained
+        from version round_number - 1.
+        """
+        latest_version = self.round_number - 1
+        if latest_version < 0:
+            # No version yet: the first buffer averages full weights
+            return self.round_updates.add(client_id, request)
+        
+        base_version = request.round_number - 1
+        staleness = latest_version - base_version
+        if base_version < 0:
+            logger.warning(f"Dropping update from client '{client_id}': trained from its own initialization")
+            return False
+        if staleness > self.max_staleness:
+            logger.warning(f"Dropping update from client '{client_id}': base version {base_version} "
+                           f"is {staleness} versions old (max {self.max_staleness})")
+            return False
+        base_weights = None  # delta updates only need their staleness
+        if not request.is_delta:
+            base_weights = self.model_history.get(base_version)
+            if base_weights is None:
+                logger.warning(f"Dropping update from client '{client_id}': base version {base_version} is not available")
+                return False
+        logger.info(f"Client '{client_id}' update: base version {base_version}, staleness {staleness}, "
+                    f"weight {self.staleness_fn(staleness):.4f}")
+        return self.round_updates.add(client_id, request, base_weights, staleness)
+    
+    def _update_weight(self, request):
+        """
+        FedAvg weight of a sync update: its num_examples, so hospitals with more patients
+        count proportionally more. Clients that don't report it get weight 1.
+        """
+        if self.weighting == 'uniform':
+            return 1.0
+        if request.num_examples <= 0:
+            logger.warning(f"Client '{request.client_id}' did not report num_examples, using weight 1")
+            return 1.0
+        return float(request.num_examples)
+    
+    def _add_sync_update(self, client_id, request):
+        """Add an update to the round in progress, applying the late-update policy. Caller holds self.lock."""
+        if request.is_delta and self.global_weights is None:
+            raise ValueError(f"Client '{client_id}' sent a delta update but no global model was published yet")
+        weight = self._update_weight(request)
+        if self.round_deadline > 0 and request.round_number < self.round_number:
+            if self.late_update_policy == 'drop':
+                logger.warning(f"Dropping late update from client '{client_id}' for closed round {request.round_number}")
+                return False
+            logger.info(f"Carrying late update from client '{client_id}' (round {request.round_number}) "
+                        f"into round {self.round_number}")
+            # Kept apart from the client's own update for this round, and not counted towards closing it
+            added = self.round_updates.add(f"{client_id}@round{request.round_number}", request, weight)
+            self.carried_updates += int(added)
+            return added
+        return self.round_updates.add(client_id, request, weight)
     
     def TransmitWeights(self, request, context):
         """Receive weights from a client and trigger aggregation if ready"""
+        try:
+            self.receive_update(request)
+        except ValueError as e:
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(e))
+        return empty_pb2.Empty()
+    
+    def receive_update(self, request):
+        """
+        Add a client's ModelWeights to the round in progress and close the round if ready.
+        Updates sent through the shared volume are memory-mapped first.
+
+        Raises:
+            ValueError: If the update cannot be used (logged before raising)
+        """
         client_id = request.client_id
+        if request.HasField('shared'):
+            # Map the update from the shared volume (and verify it) before taking the lock
+            try:
+                request = map_shared_update(request, self.shared_updates_dir)
+            except ValueError as e:
+                logger.error(str(e))
+                raise
         
         with self.lock:
-            self.received_weights[client_id] = request
-            num_received = len(self.received_weights)
-            logger.info(f"Received weights from client '{client_id}' ({num_received}/{self.num_clients})")
+            try:
+                if self.aggregation_mode == 'async':
+                    added = self._add_async_update(client_id, request)
+                else:
+                    added = self._add_sync_update(client_id, request)
+            except ValueError as e:
+                logger.error(str(e))
+                raise
+            if not added:
+                logger.warning(f"Ignoring weights from client '{client_id}' in round {self.round_number}")
+                return
+            self.round_examples += request.num_examples
+            num_received = len(self.round_updates) - self.carried_updates
+            logger.info(f"Received weights from client '{client_id}' ({num_received}/{self.num_clients}, "
+                        f"{request.num_examples} examples)")
             
-            # Trigger aggregation if we have enough clients
+            # Hand the round to the aggregation worker if we have enough updates
+            if self.aggregation_mode == 'async':
+                if num_received >= self.async_buffer_size:
+                    self._close_round(f"buffer full ({num_received} >= {self.async_buffer_size})")
+            elif self.round_deadline > 0:
+                if num_received >= self.num_clients:
+                    self._close_round(f"all {num_received} clients reported")
+                elif self.deadline_expired and num_received >= self.min_clients:
+                    self._close_round(f"quorum reached after deadline ({num_received} >= {self.min_clients})")
+                elif self.round_timer is None:
+                    self._start_round_timer()
+            elif num_received >= self.min_clients:
+                self._close_round(f"threshold reached ({num_received} >= {self.min_clients})")
+    
+    def _start_round_timer(self):
+        """Start the deadline of the round in progress. Caller holds self.lock."""
+        self.round_timer = threading.Timer(self.round_deadline, self._on_round_deadline, args=(self.round_number,))
+        self.round_timer.daemon = True
+        self.round_timer.start()
+    
+    def _on_round_deadline(self, round_number):
+        """Deadline timer callback: close the round with the updates received so far if the quorum is met"""
+        with self.lock:
+            if round_number != self.round_number:
+                return  # closed before the deadline
+            self.deadline_expired = True
+            num_received = len(self.round_updates) - self.carried_updates
             if num_received >= self.min_clients:
-                logger.info(f"Threshold reached ({num_received} >= {self.min_clients}). Performing FedAvg...")
-                self.federated_averaging()
-                self.received_weights.clear()  # Reset for next round
-                self.round_number += 1
-        
-        return empty_pb2.Empty()
+                self._close_round(f"deadline expired with quorum ({num_received}/{self.num_clients} clients)")
+            else:
+                logger.warning(f"Round {round_number} deadline expired with {num_received} updates, "
+                               f"waiting for quorum of {self.min_clients}")
     
-    def federated_averaging(self):
-        """Perform federated averaging on collected weights"""
-        if not self.received_weights:
-            logger.warning("No weights to aggregate")
-            return
-        
-        num_clients = len(self.received_weights)
-        logger.info(f"Aggregating weights from {num_clients} clients")
-        
-        # Convert protobuf weights to numpy arrays
-        all_client_weights = []
-        for client_id, model_weights in self.received_weights.items():
-            client_weights_list = []
-            for tensor in model_weights.tensors:
-                # Reconstruct numpy array from flattened data and shape
-                array = np.array(tensor.data, dtype=np.float32).reshape(tensor.shape)
-                client_weights_list.append(array)
-            all_client_weights.append(client_weights_list)
-            logger.info(f"  - Client '{client_id}': {len(client_weights_list)} weight tensors")
-        
-        # Perform averaging: average each layer across all clients
-        aggregated_weights = []
-        num_layers = len(all_client_weights[0])
-        
-        for layer_idx in range(num_layers):
-            # Stack weights from all clients for this layer
-            layer_weights = [client_weights[layer_idx] for client_weights in all_client_weights]
-            # Average them
-            avg_weight = np.mean(layer_weights, axis=0)
-            aggregated_weights.append(avg_weight)
-        
-        # Store global weights
-        self.global_weights = aggregated_weights
-        logger.info(f"✓ Round {self.round_number} complete: Global model updated with {num_layers} layers")
-        
-        # Log weight statistics for verification
-        for i, w in enumerate(aggregated_weights):
-            logger.info(f"  Layer {i}: shape={w.shape}, mean={w.mean():.6f}, std={w.std():.6f}")
-        
-        # Save weights to disk for evaluation
-        self.save_global_weights()
+    def _close_round(self, reason):
+        """Queue the round in progress for aggregation and open the next one. Caller holds self.lock."""
+        logger.info(f"Closing round {self.round_number}: {reason}. Queueing for FedAvg...")
+        if self.round_timer is not None:
+            self.round_timer.cancel()
+            self.round_timer = None
+        self.deadline_expired = False
+        self.carried_updates = 0
+        self.aggregation_queue.put((self.round_number, self.round_updates, self.round_examples))
+        self.round_examples = 0
+        # Reset for next round
+        self.round_updates = self._new_round_updates()
+        self.round_number += 1
     
-    # Not used yet, but could be extended to support weighted averaging based on dataset sizes
-    def weighted_federated_averaging(self, dataset_sizes):
+    def UploadWeights(self, request_iterator, context):
         """
-        Perform weighted federated averaging on collected weights.
-        
-        Weights are averaged proportionally to each client's dataset size.
-        Formula: global_weight = sum(n_i * w_i) / sum(n_i)
-        
+        Receive a serialized ModelWeights in chunks (client streaming).
+
+        Chunks are copied into a buffer preallocated from `total_size`. If the stream
+        breaks, the received bytes are kept so the client can ask GetUploadStatus for
+        the committed offset and resume from there with the same upload_id.
+        """
+        upload = None
+        for chunk in request_iterator:
+            try:
+                upload, completed = self.write_chunk(chunk)
+                if completed:
+                    self.finish_upload(upload)
+            except UploadRejected as e:
+                context.abort(e.code, str(e))
+            except ValueError as e:
+                context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(e))
+            if upload.complete:
+                break
+        return self.upload_status(upload)
+    
+    def write_chunk(self, chunk):
+        """
+        Apply one WeightsChunk to its upload, starting the upload if it is new.
+
+        Returns:
+            (PendingUpload, True if this chunk completed it)
+
+        Raises:
+            UploadRejected: If the chunk does not fit the upload
+        """
+        upload_id = chunk.upload_id
+        with self.upload_lock:
+            upload = self.uploads.get(upload_id)
+            if upload is None:
+                if not 0 < chunk.total_size <= self.max_upload_bytes:
+                    raise UploadRejected(grpc.StatusCode.INVALID_ARGUMENT,
+                                         f"Upload '{upload_id}' announces {chunk.total_size} bytes, "
+                                         f"the limit is {self.max_upload_bytes}")
+                self._purge_stale_uploads()
+                upload = PendingUpload(upload_id, chunk.client_id, chunk.total_size)
+                self.uploads[upload_id] = upload
+                logger.info(f"Started upload '{upload_id}' from client '{chunk.client_id}' ({chunk.total_size} bytes)")
+            elif upload.total_size != chunk.total_size:
+                raise UploadRejected(grpc.StatusCode.INVALID_ARGUMENT,
+                                     f"Upload '{upload_id}' was started with a different total size")
+            if upload.complete:
+                return upload, False
+            if not upload.write(chunk.offset, chunk.data):
+                raise UploadRejected(grpc.StatusCode.OUT_OF_RANGE,
+                                     f"Chunk at offset {chunk.offset} is past committed offset {upload.committed_offset}")
+            return upload, upload.complete
+    
+    def finish_upload(self, upload):
+        """
+        Parse a completed upload and hand it to receive_update, recording whether it was accepted.
+
+        Raises:
+            ValueError: If the payload is not a ModelWeights or receive_update rejects it
+        """
+        try:
+            try:
+                model_weights_msg = weights_transmitting_pb2.ModelWeights.FromString(upload.buffer)
+            except DecodeError as e:
+                logger.error(f"Upload '{upload.upload_id}' from client '{upload.client_id}' is corrupt: {e}")
+                raise ValueError(f"Upload '{upload.upload_id}' is not a valid ModelWeights: {e}")
+            self.receive_update(model_weights_msg)
+        except ValueError as e:
+            with self.upload_lock:
+                upload.accepted, upload.error = False, str(e)
+            raise
+        finally:
+            with self.upload_lock:
+                upload.buffer = bytearray()  # keep only the bookkeeping for status queries
+        with self.upload_lock:
+            upload.accepted = True
+    
+    @staticmethod
+    def upload_status(upload):
+        """UploadStatus of an upload; complete only once its update was accepted or rejected"""
+        if upload is None:
+            return weights_transmitting_pb2.UploadStatus()
+        return weights_transmitting_pb2.UploadStatus(
+            upload_id=upload.upload_id, committed_offset=upload.committed_offset,
+            complete=upload.complete and upload.accepted is not None,
+            rejected=upload.accepted is False, error=upload.error,
+        )
+    
+    def GetUploadStatus(self, request, context):
+        """Report how much of an upload has been received, so the client can resume it"""
+        with self.upload_lock:
+            upload = self.uploads.get(request.upload_id)
+            if upload is None:
+                return weights_transmitting_pb2.UploadStatus(upload_id=request.upload_id)
+            return self.upload_status(upload)
+    
+    def _purge_stale_uploads(self):
+        """Drop uploads (finished or abandoned) untouched for longer than upload_ttl. Caller holds upload_lock."""
+        now = time.monotonic()
+        for upload_id in [uid for uid, u in self.uploads.items() if now - u.last_update > self.upload_ttl]:
+            upload = self.uploads.pop(upload_id)
+            if not upload.complete:
+                logger.warning(f"Dropping abandoned upload '{upload_id}' from client '{upload.client_id}'")
+    
+    def _aggregation_loop(self):
+        """Aggregation worker: average closed rounds from the queue, one at a time"""
+        while True:
+            job = self.aggregation_queue.get()
+            try:
+                if job is None:
+                    return
+                self.federated_averaging(*job)
+            except Exception:
+                logger.exception("Aggregation failed")
+            finally:
+                self.aggregation_queue.task_done()
+    
+    def stop(self):
+        """Finish queued rounds and stop the aggregation worker"""
+        self.aggregation_queue.put(None)
+        self.aggregation_worker.join()
+    
+    def _back_buffer(self, layout):
+        """Return (index, flat vector) of the model buffer not currently published, allocating it if needed"""
+        index = 1 - self.front_buffer
+        buffer = self.model_buffers[index]
+        if buffer is None or buffer[0] != layout:
+            buffer = (layout, layout.allocate())
+            self.model_buffers[index] = buffer
+        return index, buffer[1]
+    
+    def _remember_version(self, round_number, layout, flat):
+        """Keep a copy of a published version for async deltas, dropping those past max_staleness"""
+        with self.lock:
+            self.model_history[round_number] = layout.views(flat.copy())
+            for version in [v for v in self.model_history if v < round_number - self.max_staleness]:
+                del self.model_history[version]
+    
+    def federated_averaging(self, round_number, updates, num_examples=0):
+        """
+        Perform federated averaging on a closed round's updates (runs on the aggregation worker).
+
         Args:
-            dataset_sizes: Dict mapping client_id to number of samples
-                          e.g., {'client_0': 1000, 'client_1': 1500, ...}
-        
-        This is more realistic for medical settings where hospitals have
-        different numbers of patients.
+            num_examples: Total examples reported by the round's updates (forwarded upstream by edges)
         """
-        if not self.received_weights:
+        if not len(updates):
             logger.warning("No weights to aggregate")
             return
         
-        num_clients = len(self.received_weights)
-        logger.info(f"Aggregating weights from {num_clients} clients (weighted by dataset size)")
+        logger.info(f"Aggregating weights from {len(updates)} clients ({self.aggregation_mode})")
+        layout = updates.layout
+        index, aggregated_flat = self._back_buffer(layout)
+        start = time.perf_counter()
+        updates.aggregate(aggregated_flat, self.global_flat)
+        logger.info(f"✓ {type(updates).__name__} aggregated {len(updates)} updates in "
+                    f"{time.perf_counter() - start:.3f}s, working buffers {updates.working_bytes / 2**20:.1f} MiB")
+        if self.upstream is not None:
+            round_number = self._exchange_with_root(round_number, layout, aggregated_flat, num_examples)
+        elif self.server_optimizer is not None and self.global_flat is not None:
+            # Treat (average - global) as a pseudo-gradient instead of taking the average as-is
+            self.server_optimizer.apply([self.global_flat], [aggregated_flat])
+        aggregated_weights = layout.views(aggregated_flat)
+        num_layers = len(aggregated_weights)
         
-        # Convert protobuf weights to numpy arrays
-        all_client_weights = []
-        client_ids = []
-        weights_per_client = []
-        
-        total_samples = 0
-        for client_id, model_weights in self.received_weights.items():
-            client_weights_list = []
-            for tensor in model_weights.tensors:
-                # Reconstruct numpy array from flattened data and shape
-                array = np.array(tensor.data).reshape(tensor.shape)
-                client_weights_list.append(array)
-            
-            all_client_weights.append(client_weights_list)
-            client_ids.append(client_id)
-            
-            # Get dataset size for this client (default to 1 if not provided)
-            num_samples = dataset_sizes.get(client_id, 1)
-            weights_per_client.append(num_samples)
-            total_samples += num_samples
-            
-            logger.info(f"  - Client '{client_id}': {len(client_weights_list)} tensors, {num_samples} samples")
-        
-        # Normalize weights to sum to 1
-        normalized_weights = [w / total_samples for w in weights_per_client]
-        logger.info(f"  Total samples: {total_samples}")
-        logger.info(f"  Normalized weights: {[f'{w:.4f}' for w in normalized_weights]}")
-        
-        # Perform weighted averaging: weighted sum for each layer
-        aggregated_weights = []
-        num_layers = len(all_client_weights[0])
-        
-        for layer_idx in range(num_layers):
-            # Weighted sum of this layer across all clients
-            weighted_layer = None
-            for client_idx, client_weights in enumerate(all_client_weights):
-                layer_weight = client_weights[layer_idx] * normalized_weights[client_idx]
-                if weighted_layer is None:
-                    weighted_layer = layer_weight
-                else:
-                    weighted_layer += layer_weight
-            
-            aggregated_weights.append(weighted_layer)
-        
-        # Store global weights
+        # Swap the finished back buffer in as the new global model
+        self.front_buffer = index
+        self.global_flat = aggregated_flat
         self.global_weights = aggregated_weights
-        logger.info(f"✓ Round {self.round_number} complete: Global model updated with {num_layers} layers (weighted)")
+        if self.aggregation_mode == 'async':
+            self._remember_version(round_number, layout, aggregated_flat)
+        self.publish_global_weights(round_number, aggregated_weights)
+        logger.info(f"✓ Round {round_number} complete: Global model updated with {num_layers} layers")
         
         # Log weight statistics for verification
         for i, w in enumerate(aggregated_weights):
             logger.info(f"  Layer {i}: shape={w.shape}, mean={w.mean():.6f}, std={w.std():.6f}")
+        
+        # Checkpoint for evaluation and crash recovery
+        self.save_global_weights(round_number)
+    
+    def _exchange_with_root(self, round_number, layout, aggregated_flat, num_examples):
+        """
+        Edge aggregators: forward the group's aggregate upstream, then overwrite it with the
+        root's global model of that round. Returns the round number of the root's model.
+        """
+        self.upstream.forward(round_number, layout.views(aggregated_flat), num_examples)
+        root_weights_msg = self.upstream.wait_for_round(round_number)
+        if FlatLayout.from_tensors(root_weights_msg.tensors) != layout:
+            raise ValueError(f"Root model of round {root_weights_msg.round_number} has a different layout")
+        layout.flatten(proto_to_weights(root_weights_msg), out=aggregated_flat)
+        if root_weights_msg.round_number > round_number:
+            logger.warning(f"Root is already at round {root_weights_msg.round_number}, skipping ahead")
+            with self.lock:
+                self.round_number = max(self.round_number, root_weights_msg.round_number + 1)
+        return root_weights_msg.round_number
     
     def get_global_weights(self):
         """Return the current global model weights (for future use)"""
         with self.lock:
             return self.global_weights
     
+    def publish_global_weights(self, round_number, weights):
+        """
+        Serialize the new global model once and swap it in for GetGlobalWeights.
+
+        Replacing the cache reference is atomic, so readers never need self.lock.
+        Clients blocked in WaitForGlobalModel are woken up and publish_listeners are called.
+        """
+        cache = SerializedModelCache(round_number, weights)
+        with self.published:
+            self.global_model_cache = cache
+            self.published.notify_all()
+        for listener in self.publish_listeners:
+            listener(cache)
+    
     def GetGlobalWeights(self, request, context):
-        """Send global weights to a requesting client"""
-        with self.lock:
-            if self.global_weights is None:
-                logger.warning("No global weights available yet")
-                return weights_transmitting_pb2.ModelWeights()  # Empty message
-            
-            # Convert numpy arrays back to protobuf
-            msg = weights_transmitting_pb2.ModelWeights()
-            msg.client_id = "global"
-            for w in self.global_weights:
-                tensor = weights_transmitting_pb2.WeightTensor()
-                tensor.data.extend(w.flatten().tolist())
-                tensor.shape.extend(w.shape)
-                msg.tensors.append(tensor)
-            
-            logger.info(f"✓ Sending global weights (round {self.round_number}) to client")
-            return msg
+        """Send the cached, already-serialized global weights to a requesting client"""
+        cache = self.global_model_cache
+        if cache is None:
+            logger.warning("No global weights available yet")
+            return weights_transmitting_pb2.ModelWeights()  # Empty message
+        
+        # Old clients leave tensor_encoding unset and get the repeated-float form
+        payload = cache.get(request.tensor_encoding)
+        logger.info(f"✓ Sending global weights (round {cache.round_number}) to client")
+        return payload
     
-    def save_global_weights(self):
-        """Save global weights to disk for evaluation"""
-        if self.global_weights is None:
+    def WaitForGlobalModel(self, request, context):
+        """
+        Long-poll for the global model of `request.round_number`.
+
+        Returns as soon as that round (or a later one) is published. If the wait times
+        out, the latest published model is returned instead (empty if there is none);
+        its round_number tells the client which round it got.
+        """
+        timeout = request.timeout_seconds if request.timeout_seconds > 0 else self.max_wait_seconds
+        timeout = min(timeout, self.max_wait_seconds)
+        if context is not None and context.time_remaining() is not None:
+            timeout = min(timeout, context.time_remaining())
+        
+        def is_published():
+            cache = self.global_model_cache
+            return cache is not None and cache.round_number >= request.round_number
+        
+        with self.published:
+            ready = self.published.wait_for(is_published, timeout=timeout)
+        
+        cache = self.global_model_cache
+        if cache is None:
+            logger.warning(f"No global weights published while waiting for round {request.round_number}")
+            return weights_transmitting_pb2.ModelWeights()
+        if not ready:
+            logger.warning(f"Timed out waiting for round {request.round_number}, sending round {cache.round_number}")
+        else:
+            logger.info(f"✓ Sending global weights (round {cache.round_number}) to waiting client")
+        return cache.get(request.tensor_encoding)
+    
+    def save_global_weights(self, round_number):
+        """Checkpoint the global model of `round_number` (one atomic write of the flat vector)"""
+        if self.global_flat is None:
             logger.warning("No global weights to save")
             return
         
         try:
-            output_path = os.path.join(self.weights_output_dir, 'global_model_weights.pkl')
-            with open(output_path, 'wb') as f:
-                pickle.dump(self.global_weights, f)
+            output_path = self.checkpoints.save(round_number, self.model_buffers[self.front_buffer][0], self.global_flat)
             logger.info(f"✓ Saved global weights to {output_path}")
         except Exception as e:
             logger.error(f"Failed to save weights: {e}")
 
-def serve():
-    """Start the gRPC server"""
+def add_servicer_to_server(servicer, server):
+    """
+    Register the SendWeights service.
+
+    Same as weights_transmitting_pb2_grpc.add_SendWeightsServicer_to_server, except that
+    methods answering with ModelWeights may return already-serialized bytes, which are
+    sent as-is instead of being serialized again for every client.
+    """
+    def serialize_model_weights(response):
+        if isinstance(response, bytes):
+            return response
+        return response.SerializeToString()
+    
+    pb2 = weights_transmitting_pb2
+    rpc_method_handlers = {
+        'TransmitWeights': grpc.unary_unary_rpc_method_handler(
+            servicer.TransmitWeights,
+            request_deserializer=pb2.ModelWeights.FromString,
+            response_serializer=empty_pb2.Empty.SerializeToString,
+        ),
+        'GetGlobalWeights': grpc.unary_unary_rpc_method_handler(
+            servicer.GetGlobalWeights,
+            request_deserializer=pb2.GetWeightsRequest.FromString,
+            response_serializer=serialize_model_weights,
+        ),
+        'WaitForGlobalModel': grpc.unary_unary_rpc_method_handler(
+            servicer.WaitForGlobalModel,
+            request_deserializer=pb2.GetWeightsRequest.FromString,
+            response_serializer=serialize_model_weights,
+        ),
+        'UploadWeights': grpc.stream_unary_rpc_method_handler(
+            servicer.UploadWeights,
+            request_deserializer=pb2.WeightsChunk.FromString,
+            response_serializer=pb2.UploadStatus.SerializeToString,
+        ),
+        'GetUploadStatus': grpc.unary_unary_rpc_method_handler(
+            servicer.GetUploadStatus,
+            request_deserializer=pb2.UploadStatusRequest.FromString,
+            response_serializer=pb2.UploadStatus.SerializeToString,
+        ),
+    }
+    generic_handler = grpc.method_handlers_generic_handler('SendWeights', rpc_method_handlers)
+    server.add_generic_rpc_handlers((generic_handler,))
+
+def servicer_from_env():
+    """Build the WeightsAggregatorService configured by the environment"""
     # Read config from environment; default to full synchronous (min_clients=5)
     num_clients = int(os.environ.get('NUM_CLIENTS', '5'))
     min_clients = int(os.environ.get('MIN_CLIENTS', '5'))
-    logger.info(f"Aggregator config: num_clients={num_clients}, min_clients={min_clients}")
+    upload_ttl = int(os.environ.get('UPLOAD_TTL_SECONDS', '600'))
+    max_upload_bytes = int(os.environ.get('MAX_UPLOAD_BYTES', str(DEFAULT_MAX_UPLOAD_BYTES)))
+    # Shared-volume updates are only read from (and removed in) this directory
+    shared_updates_dir = os.environ.get('SHARED_UPDATES_DIR', DEFAULT_SHARED_UPDATES_DIR)
+    # 'streaming' keeps one running-sum buffer, 'buffered' keeps every client's message until the round closes
+    aggregation_mode = os.environ.get('AGGREGATION_MODE', 'streaming')
+    accumulator_dtype = os.environ.get('ACCUMULATOR_DTYPE', 'float64')
+    max_wait_seconds = float(os.environ.get('MAX_WAIT_SECONDS', '600'))
+    # Async (FedBuff) mode: publish a new version every ASYNC_BUFFER_SIZE updates, discounting stale ones
+    async_buffer_size = int(os.environ.get('ASYNC_BUFFER_SIZE', '3'))
+    staleness_function = os.environ.get('STALENESS_FUNCTION', 'polynomial')
+    staleness_alpha = float(os.environ.get('STALENESS_ALPHA', '0.5'))
+    staleness_hinge = int(os.environ.get('STALENESS_HINGE', '4'))
+    max_staleness = int(os.environ.get('MAX_STALENESS', '8'))
+    # Sync deadline: close a round ROUND_DEADLINE_SECONDS after its first update once MIN_CLIENTS (quorum) reported
+    round_deadline = float(os.environ.get('ROUND_DEADLINE_SECONDS', '0'))
+    late_update_policy = os.environ.get('LATE_UPDATE_POLICY', 'drop')
+    # 'examples' weights FedAvg by each client's reported num_examples, 'uniform' is the plain mean
+    weighting = os.environ.get('AGGREGATION_WEIGHTING', 'examples')
+    # Robust modes ('median', 'trimmed_mean'): reduce AGGREGATION_CHUNK_SIZE parameters at a time
+    trim_fraction = float(os.environ.get('TRIM_FRACTION', '0.1'))
+    aggregation_chunk_size = int(os.environ.get('AGGREGATION_CHUNK_SIZE', str(DEFAULT_CHUNK_SIZE)))
+    checkpoint_dir = os.environ.get('CHECKPOINT_DIR', '/dataset/checkpoints')
+    checkpoint_keep = int(os.environ.get('CHECKPOINT_KEEP', '5'))
+    # Two-tier topology: an 'edge' aggregator serves a site group and forwards to UPSTREAM_ADDRESS
+    role = os.environ.get('AGGREGATOR_ROLE', 'root')
+    upstream = None
+    if role == 'edge':
+        edge_id = os.environ.get('EDGE_ID') or os.environ.get('POD_NAME') or socket.gethostname()
+        upstream = UpstreamLink(os.environ['UPSTREAM_ADDRESS'], edge_id,
+                                wait_timeout=float(os.environ.get('MAX_WAIT_SECONDS', '600')))
+    elif role != 'root':
+        raise ValueError(f"Unknown aggregator role: {role}")
+    # FedOpt: 'fedavgm', 'fedadam' or 'fedyogi' step on the averaged delta, 'fedavg' takes the average as-is
+    server_optimizer_name = os.environ.get('SERVER_OPTIMIZER', 'fedavg')
+    server_lr = float(os.environ['SERVER_LR']) if os.environ.get('SERVER_LR') else None
+    server_optimizer = make_server_optimizer(
+        server_optimizer_name,
+        lr=server_lr,
+        momentum=float(os.environ.get('SERVER_MOMENTUM', '0.9')),
+        beta1=float(os.environ.get('SERVER_BETA1', '0.9')),
+        beta2=float(os.environ.get('SERVER_BETA2', '0.99')),
+        tau=float(os.environ.get('SERVER_TAU', '1e-3')),
+    )
+    logger.info(f"Aggregator config: num_clients={num_clients}, min_clients={min_clients}, "
+                f"aggregation_mode={aggregation_mode}, accumulator_dtype={accumulator_dtype}, "
+                f"server_optimizer={server_optimizer_name}, role={role}")
     
-    server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))
-    weights_transmitting_pb2_grpc.add_SendWeightsServicer_to_server(
-        WeightsAggregatorService(num_clients=num_clients, min_clients=min_clients), server
+    return WeightsAggregatorService(
+        num_clients=num_clients,
+        min_clients=min_clients,
+        upload_ttl=upload_ttl,
+        aggregation_mode=aggregation_mode,
+        accumulator_dtype=accumulator_dtype,
+        max_wait_seconds=max_wait_seconds,
+        async_buffer_size=async_buffer_size,
+        staleness_function=staleness_function,
+        staleness_alpha=staleness_alpha,
+        staleness_hinge=staleness_hinge,
+        max_staleness=max_staleness,
+        round_deadline=round_deadline,
+        late_update_policy=late_update_policy,
+        weighting=weighting,
+        server_optimizer=server_optimizer,
+        trim_fraction=trim_fraction,
+        aggregation_chunk_size=aggregation_chunk_size,
+        checkpoint_dir=checkpoint_dir,
+        checkpoint_keep=checkpoint_keep,
+        upstream=upstream,
+        max_upload_bytes=max_upload_bytes,
+        shared_updates_dir=shared_updates_dir,
     )
+
+def serve():
+    """Start the gRPC server"""
+    servicer = servicer_from_env()
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))
+    add_servicer_to_server(servicer, server)
     
     listen_addr = '[::]:50051'
     server.add_insecure_port(listen_addr)
@@ -233,6 +794,7 @@ def serve():
     except KeyboardInterrupt:
         logger.info("Shutting down aggregator server...")
         server.stop(0)
+        servicer.stop()
 
 if __name__ == '__main__':
     serve()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the full-resolution and reduced-resolution (FAST_JPEG_DECODE) JPEG decode paths.
+
+Reports images/sec of the training input preprocessing for both paths, how far the
+resulting 128x128 images are apart, and, if a global model checkpoint exists, the
+validation accuracy and AUC of that model with images from either path. Exits with
+status 1 if the accuracy with fast decoding drops by more than --tolerance.
+
+Usage:
+    python3 federated_training/benchmark_decode.py [--limit 500] [--tolerance 0.01]
+"""
+
+import argparse
+import logging
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+
+from checkpoints import CheckpointStore
+from data_loader import AUTOTUNE, load_and_preprocess_image
+from evaluate_model import create_model, evaluate_model, load_checkpoint_weights, make_validation_dataset
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+def preprocess_all(paths, fast_decode, batch_size=64):
+    """Run the training preprocessing over `paths`, returning (images, seconds)"""
+    ds = tf.data.Dataset.from_tensor_slices(paths)
+    ds = ds.map(lambda path: load_and_preprocess_image(path, fast_decode), num_parallel_calls=AUTOTUNE)
+    ds = ds.batch(batch_size).prefetch(AUTOTUNE)
+    start = time.perf_counter()
+    images = np.concatenate([batch.numpy() for batch in ds])
+    return images, time.perf_counter() - start
+
+def main():
+    chexpert_root = '/data/federated-learning-medical-images'
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--csv', default=os.path.join(chexpert_root, 'CheXpert-v1.0/valid.csv'))
+    parser.add_argument('--image-root', default=chexpert_root)
+    parser.add_argument('--checkpoint-dir', default=os.path.join(chexpert_root, 'CheXpert-v1.0/checkpoints'))
+    parser.add_argument('--limit', type=int, default=500, help='Images used for the throughput measurement')
+    parser.add_argument('--tolerance', type=float, default=0.01, help='Largest accepted accuracy drop')
+    args = parser.parse_args()
+
+    df = pd.read_csv(args.csv)
+    paths = [os.path.join(args.image_root, p) for p in df['Path'].iloc[:args.limit]]
+    logger.info(f"Benchmarking decode paths on {len(paths)} images from {args.csv}")
+
+    # One untimed pass so both paths read from the page cache
+    preprocess_all(paths, fast_decode=True)
+    full_images, full_seconds = preprocess_all(paths, fast_decode=False)
+    fast_images, fast_seconds = preprocess_all(paths, fast_decode=True)
+    difference = np.abs(full_images - fast_images)
+
+    logger.info("=" * 60)
+    logger.info(f"Full decode:        {len(paths) / full_seconds:8.1f} images/sec")
+    logger.info(f"Fast decode:        {len(paths) / fast_seconds:8.1f} images/sec "
+                f"({full_seconds / fast_seconds:.2f}x)")
+    logger.info(f"Pixel difference:   mean {difference.mean():.2f}, max {difference.max():.2f} (0-255 scale)")
+    logger.info("=" * 60)
+
+    if not CheckpointStore(args.checkpoint_dir).rounds():
+        logger.warning(f"No checkpoint in {args.checkpoint_dir}, skipping the accuracy check")
+        return
+
+    model = create_model()
+    model.set_weights(load_checkpoint_weights(args.checkpoint_dir))
+    metrics = {}
+    for fast_decode in (False, True):
+        validation_ds, true_labels = make_validation_dataset(args.csv, args.image_root, fast_decode=fast_decode)
+        if validation_ds is None:
+            sys.exit(1)
+        metrics[fast_decode] = evaluate_model(model, validation_ds, true_labels)
+
+    accuracy_drop = metrics[False]['accuracy'] - metrics[True]['accuracy']
+    logger.info(f"Accuracy:           full {metrics[False]['accuracy']:.4f}, fast {metrics[True]['accuracy']:.4f}")
+    logger.info(f"AUC (ROC):          full {metrics[False]['auc']:.4f}, fast {metrics[True]['auc']:.4f}")
+    logger.info("=" * 60)
+    if accuracy_drop > args.tolerance:
+        logger.warning(f"⚠ Fast decoding loses {accuracy_drop:.4f} accuracy (tolerance {args.tolerance})")
+        sys.exit(1)
+    logger.info(f"✓ Fast decoding holds accuracy within {args.tolerance}")
+
+if __name__ == '__main__':
+    main()
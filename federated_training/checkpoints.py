@@ -0,0 +1,120 @@
+"""
+Versioned, atomically written global model checkpoints.
+
+Each published round is stored as two files in the checkpoint directory:
+    global_round_000012.npy   the flat float32 parameter vector (see flat_params)
+    global_round_000012.json  round number and layer index (name, offset, shape)
+
+Both are written to a temporary file and renamed into place, the .json last, so a
+checkpoint only exists once it is complete. The .npy can be opened with
+np.load(mmap_mode='r'), so readers map the weights instead of deserializing them.
+"""
+
+import json
+import logging
+import os
+import re
+import time
+
+import numpy as np
+
+from flat_params import FlatLayout
+
+logger = logging.getLogger(__name__)
+
+_INDEX_PATTERN = re.compile(r'^global_round_(\d+)\.json$')
+
+
+def atomic_write(path, write):
+    """Call write(file) on a temporary file next to `path`, fsync it and rename it into place"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class CheckpointStore:
+    """Per-round checkpoints in one directory, keeping only the newest `keep`."""
+
+    def __init__(self, directory, keep=5):
+        """
+        Args:
+            directory: Where checkpoints are written (created if missing)
+            keep: Number of most recent checkpoints retained; 0 keeps all of them
+        """
+        self.directory = directory
+        self.keep = keep
+
+    def _paths(self, round_number):
+        stem = os.path.join(self.directory, f"global_round_{round_number:06d}")
+        return f"{stem}.npy", f"{stem}.json"
+
+    def rounds(self):
+        """Rounds with a complete checkpoint, oldest first"""
+        if not os.path.isdir(self.directory):
+            return []
+        matches = (_INDEX_PATTERN.match(name) for name in os.listdir(self.directory))
+        return sorted(int(match.group(1)) for match in matches if match)
+
+    def save(self, round_number, layout, flat):
+        """
+        Write the global model of `round_number` and apply the retention policy.
+
+        Args:
+            layout: FlatLayout of the model
+            flat: Flat float32 parameter vector
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        data_path, index_path = self._paths(round_number)
+        atomic_write(data_path, lambda f: np.save(f, flat, allow_pickle=False))
+        index = {'round_number': round_number, 'saved_at': time.time(), 'layout': layout.to_dict()}
+        atomic_write(index_path, lambda f: f.write(json.dumps(index).encode()))
+        self._prune()
+        return data_path
+
+    def _prune(self):
+        if not self.keep:
+            return
+        for round_number in self.rounds()[:-self.keep]:
+            data_path, index_path = self._paths(round_number)
+            # Index first, so a half-deleted checkpoint is never picked up
+            for path in (index_path, data_path):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def load(self, round_number, mmap=True):
+        """
+        Load the checkpoint of `round_number`.
+
+        Args:
+            mmap: Memory-map the parameter vector read-only instead of reading it in
+
+        Returns:
+            (FlatLayout, flat parameter vector)
+        """
+        data_path, index_path = self._paths(round_number)
+        with open(index_path) as f:
+            index = json.load(f)
+        layout = FlatLayout.from_dict(index['layout'])
+        flat = np.load(data_path, mmap_mode='r' if mmap else None, allow_pickle=False)
+        if flat.shape != (layout.size,):
+            raise ValueError(f"Checkpoint {data_path} holds {flat.size} values, its index expects {layout.size}")
+        return layout, flat
+
+    def load_latest(self, mmap=True):
+        """
+        Load the newest readable checkpoint, skipping damaged ones.
+
+        Returns:
+            (round_number, FlatLayout, flat vector), or None if there is no checkpoint
+        """
+        for round_number in reversed(self.rounds()):
+            try:
+                return (round_number, *self.load(round_number, mmap))
+            except (OSError, ValueError, KeyError) as e:
+                logger.warning(f"Skipping unreadable checkpoint of round {round_number}: {e}")
+        return None
@@ -0,0 +1,86 @@
+"""
+Compact, cached manifest of a client's labelled training images.
+
+train.csv is parsed once, in one vectorized pass, into a columnar index that is
+saved next to it as manifest.npz:
+    key            hash of train.csv, the label filter and the manifest version
+    paths          image paths relative to the client directory (unicode array)
+    label_columns  names of the label columns present in the CSV
+    labels         (images, label columns) float32; NaN where the CSV has no value
+
+Only rows whose TARGET_LABEL is 0 or 1 are kept, and paths and labels come from the
+same filtered rows, so they always line up. Later starts check the key and load the
+arrays with np.load, without parsing the CSV or doing per-row Python work.
+"""
+
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+from checkpoints import atomic_write
+from image_cache import manifest_key
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_VERSION = 1
+MANIFEST_FILE = 'manifest.npz'
+LABEL_COLUMNS = (
+    'No Finding', 'Enlarged Cardiomediastinum', 'Cardiomegaly',
+    'Lung Opacity', 'Lung Lesion', 'Edema', 'Consolidation',
+    'Pneumonia', 'Atelectasis', 'Pneumothorax', 'Pleural Effusion',
+    'Pleural Other', 'Fracture', 'Support Devices',
+)
+# 'CheXpert-v1.0/' prefix of the CSV paths, absent in the pods' file structure
+PATH_PREFIX = 'CheXpert-v1.0/'
+
+
+def build_manifest(csv_path, target_label):
+    """
+    Parse `csv_path` into manifest arrays, keeping the rows with a 0 or 1 `target_label`.
+
+    Returns:
+        Dict with 'paths', 'label_columns' and 'labels' (see the module docstring)
+    """
+    header = pd.read_csv(csv_path, nrows=0).columns
+    label_columns = [column for column in LABEL_COLUMNS if column in header]
+    df = pd.read_csv(csv_path, usecols=['Path', *label_columns],
+                     dtype={'Path': str, **{column: np.float32 for column in label_columns}})
+
+    labels = df[label_columns].to_numpy(dtype=np.float32)
+    # DISCLAIMER: we don't know what to do with -1 (uncertain diagnostic) values yet
+    keep = np.isin(labels[:, label_columns.index(target_label)], (0.0, 1.0))
+    paths = df['Path'].to_numpy(dtype=str)[keep]
+    paths = np.where(np.char.startswith(paths, PATH_PREFIX), np.char.replace(paths, PATH_PREFIX, '', count=1), paths)
+    return {'paths': paths, 'label_columns': np.array(label_columns), 'labels': labels[keep]}
+
+
+def load_manifest(client_path, target_label):
+    """
+    Manifest of a client, from its manifest.npz if that matches train.csv, else built and saved.
+
+    Returns:
+        Dict with 'paths' (absolute), 'label_columns' and 'labels'
+    """
+    csv_path = os.path.join(client_path, 'train.csv')
+    manifest_path = os.path.join(client_path, MANIFEST_FILE)
+    key = manifest_key(csv_path, target_label, MANIFEST_VERSION)
+    manifest = None
+    try:
+        with np.load(manifest_path, allow_pickle=False) as saved:
+            if str(saved['key']) == key:
+                manifest = {name: saved[name] for name in ('paths', 'label_columns', 'labels')}
+    except (OSError, KeyError, ValueError):
+        pass
+    if manifest is None:
+        manifest = build_manifest(csv_path, target_label)
+        atomic_write(manifest_path, lambda f: np.savez(f, key=np.array(key), **manifest))
+        logger.info(f"✓ Built manifest of {len(manifest['paths'])} images in {manifest_path}")
+    manifest['paths'] = np.char.add(client_path.rstrip('/') + '/', manifest['paths'])
+    return manifest
+
+
+def label_column(manifest, name):
+    """Labels of one column (e.g. TARGET_LABEL) of a manifest"""
+    return manifest['labels'][:, list(manifest['label_columns']).index(name)]
@@ -1,28 +1,120 @@
 import os
 import tensorflow as tf
-import pandas as pd
+
+from client_manifest import label_column, load_manifest
+from image_cache import ImageCache, manifest_key
+from record_shards import DEFAULT_NUM_SHARDS, RECORDS_VERSION, load_index, pack_records, record_dataset
 
 # adjust
 IMAGE_SIZE = (128, 128)
 AUTOTUNE = tf.data.AUTOTUNE
 TARGET_LABEL = 'Pleural Effusion'
+# Images decoded per batch while building the image cache
+CACHE_BUILD_BATCH = 256
+# Downscale factors libjpeg can apply while decoding (in the DCT domain), largest first
+JPEG_DECODE_RATIOS = (8, 4, 2)
+
+def decode_jpeg_for_size(contents, size, channels=1):
+    """
+    Decodes a JPEG at the smallest of 1/8, 1/4, 1/2 or full resolution that still covers `size`.
 
-def load_and_preprocess_image(path):
+    The header is read with extract_jpeg_shape to pick the ratio, so a ~2000 pixel X-ray
+    resized to 128x128 is decoded at 1/8 scale, which skips most of the IDCT and color
+    conversion work and also acts as an anti-aliasing prefilter for the final resize.
+    """
+    shape = tf.io.extract_jpeg_shape(contents)
+    height, width = shape[0], shape[1]
+
+    def covers(ratio):
+        # libjpeg rounds scaled dimensions up
+        return tf.logical_and((height + ratio - 1) // ratio >= size[0], (width + ratio - 1) // ratio >= size[1])
+
+    branches = [(covers(ratio), lambda ratio=ratio: tf.image.decode_jpeg(contents, channels=channels, ratio=ratio))
+                for ratio in JPEG_DECODE_RATIOS]
+    return tf.case(branches, default=lambda: tf.image.decode_jpeg(contents, channels=channels), exclusive=False)
+
+def load_and_preprocess_image(path, fast_decode=False):
     """
     Reads an image file from `path`, decodes it (JPEG), converts to grayscale,
     resizes to IMAGE_SIZE, and normalizes pixel values to [0,1].
+
+    With `fast_decode`, the JPEG is decoded at reduced resolution first (see decode_jpeg_for_size).
     """
-    image = tf.io.read_file(path)  # path is a Tensor
-    image = tf.image.decode_jpeg(image, channels=1)
+    return preprocess_image(tf.io.read_file(path), fast_decode)  # path is a Tensor
+
+def preprocess_image(image, fast_decode=False):
+    """load_and_preprocess_image for JPEG bytes already read (e.g. from packed records)"""
+    if fast_decode:
+        image = decode_jpeg_for_size(image, IMAGE_SIZE, channels=1)
+    else:
+        image = tf.image.decode_jpeg(image, channels=1)
     # ensure the tensor has rank 3
     image.set_shape([None, None, 1])
     image = tf.image.resize(image, IMAGE_SIZE)
     image = tf.image.convert_image_dtype(image, tf.float32)
     return image
 
-def make_dataset(client_path, batch_size=32, shuffle_buffer=100):
+def preprocess_image_uint8(image, fast_decode=False):
+    """preprocess_image rounded to uint8, the form kept in the image cache"""
+    return tf.saturate_cast(tf.round(preprocess_image(image, fast_decode)), tf.uint8)
+
+def cached_dataset(source, csv_path, cache_dir, batch_size, fast_decode=False):
     """
-    Builds a tf.data.Dataset from a client directory.
+    Batches images from the decoded-image cache, building it first if needed.
+
+    The cache is keyed by the CSV content, IMAGE_SIZE, TARGET_LABEL and the decode path; see image_cache.
+    `source` returns the (JPEG bytes, label) dataset the cache is built from and is only
+    called when the cache is not complete, so a complete cache never touches the JPEGs
+    or packed records. Every epoch shuffles all image indices (a few bytes each) and
+    gathers each batch from the memory-mapped shards in one call.
+    """
+    cache = ImageCache(cache_dir, manifest_key(csv_path, IMAGE_SIZE, TARGET_LABEL, fast_decode))
+    if not cache.is_complete():
+        decoded = source().map(lambda image, label: (preprocess_image_uint8(image, fast_decode), label),
+                         num_parallel_calls=AUTOTUNE)
+        decoded = decoded.batch(CACHE_BUILD_BATCH).prefetch(AUTOTUNE)
+        cache.write((images.numpy(), labels.numpy()) for images, labels in decoded)
+    count, image_shape, labels = cache.open()
+
+    def load_batch(indices):
+        images = tf.numpy_function(cache.gather, [indices], tf.uint8, stateful=False)
+        images.set_shape([None, *image_shape])
+        return tf.cast(images, tf.float32), tf.gather(labels, indices)
+
+    ds = tf.data.Dataset.range(count)
+    ds = ds.shuffle(count)
+    ds = ds.batch(batch_size)
+    ds = ds.map(load_batch, num_parallel_calls=AUTOTUNE)
+    ds = ds.prefetch(AUTOTUNE)
+    return ds
+
+def packed_index(records_dir, csv_path, image_paths, labels, num_shards=DEFAULT_NUM_SHARDS):
+    """
+    Index of the client's packed record shards, packing them first if needed.
+
+    The records are keyed by the CSV content and TARGET_LABEL; see record_shards.
+    """
+    key = manifest_key(csv_path, TARGET_LABEL, RECORDS_VERSION)
+    index = load_index(records_dir, key)
+    if index is None:
+        index = pack_records(image_paths, labels, records_dir, key, num_shards)
+    return index
+
+def shuffled_files(image_paths, labels):
+    """
+    (JPEG bytes, label) pairs of the image files in a new random order every epoch.
+
+    The (path, label) pairs are permuted before any file is read or decoded, so the whole
+    dataset is shuffled while the buffer only holds paths.
+    """
+    ds = tf.data.Dataset.zip((tf.data.Dataset.from_tensor_slices(image_paths),
+                              tf.data.Dataset.from_tensor_slices(labels)))
+    ds = ds.shuffle(ds.cardinality())
+    return ds.map(lambda path, label: (tf.io.read_file(path), label), num_parallel_calls=AUTOTUNE)
+
+def read_manifest(client_path):
+    """
+    Reads the client's labelled images from its cached manifest (see client_manifest).
 
     Expects:
         client_path/
@@ -34,42 +126,66 @@ def make_dataset(client_path, batch_size=32, shuffle_buffer=100):
                 patient_02/
                     ...
 
+    Returns:
+        (csv path, image paths, TARGET_LABEL labels), aligned row for row
+    """
+    manifest = load_manifest(client_path, TARGET_LABEL)
+    image_paths = manifest['paths']
+    labels = label_column(manifest, TARGET_LABEL)
+    return os.path.join(client_path, 'train.csv'), image_paths, labels
+
+def make_dataset(client_path, batch_size=32, shuffle_buffer=100, cache_dir=None, fast_decode=False,
+                 records_dir=None):
+    """
+    Builds a tf.data.Dataset from a client directory.
+
+    With `fast_decode`, JPEGs are decoded at reduced resolution before the resize
+    (see decode_jpeg_for_size).
+
+    Shuffling happens before decoding: image files are permuted by path and cached images by
+    index over the whole dataset every epoch. Packed records are only partly reshuffled (shard
+    order, interleaving and a `shuffle_buffer` of encoded records); their order within a shard
+    is fixed when they are packed. No decoded images are buffered for it.
+
+    With `records_dir`, the images are packed once into a few large TFRecord shards there
+    (see packed_index) and read from those with parallel interleave instead of one file
+    at a time.
+
+    With `cache_dir`, images are decoded once into a uint8 cache there (see
+    cached_dataset) and read back from it on every later epoch and run. Records are then
+    only packed and read while the cache is being built, never once it is complete.
+
+    Expects the layout described in read_manifest.
+
     Returns:
         A tf.data.Dataset yielding (image, label) batches.
     """
-    csv_path = os.path.join(client_path, 'train.csv')
-    df = pd.read_csv(csv_path)
-
-    # remove 'CheXpert-1v.0' prefix due to Kubernetes pods file structure
-    df['AdjustedPath'] = df['Path'].str.replace(r'^CheXpert-v1\.0/', '', regex=True)
-    image_paths = df['AdjustedPath'].apply(lambda p: os.path.join(client_path, p)).tolist()
-    # label_cols = [
-    #     'No Finding', 'Enlarged Cardiomediastinum', 'Cardiomegaly',
-    #     'Lung Opacity', 'Lung Lesion', 'Edema', 'Consolidation',
-    #     'Pneumonia', 'Atelectasis', 'Pneumothorax', 'Pleural Effusion',
-    #     'Pleural Other', 'Fracture', 'Support Devices'
-    # ]
-
-    # filter out rows without labels
-    # TBD how this will be done cleaner in the future
-    df = df[df[TARGET_LABEL].notna()]
-    df = df[df[TARGET_LABEL].isin([0.0, 1.0])] # DISCLAIMER: we don't know what to do with -1 (uncertain diagnostic) values yet
-    labels = df[TARGET_LABEL].astype('float32').values
-    # labels = df[label_cols].astype('float32').values.tolist()
-
-    # create TF Dataset from tensors
-    path_ds = tf.data.Dataset.from_tensor_slices(image_paths)
-    label_ds = tf.data.Dataset.from_tensor_slices(labels)
-    ds = tf.data.Dataset.zip((path_ds, label_ds))
-
-    # load images and preprocess
+    csv_path, image_paths, labels = read_manifest(client_path)
+
+    if cache_dir is not None:
+        def source():
+            # Built in stored order, so the one pass over the source reads sequentially
+            if records_dir is not None:
+                return record_dataset(records_dir, packed_index(records_dir, csv_path, image_paths, labels))
+            ds = tf.data.Dataset.zip((tf.data.Dataset.from_tensor_slices(image_paths),
+                                      tf.data.Dataset.from_tensor_slices(labels)))
+            return ds.map(lambda path, label: (tf.io.read_file(path), label), num_parallel_calls=AUTOTUNE)
+        return cached_dataset(source, csv_path, cache_dir, batch_size, fast_decode)
+
+    # create shuffled TF Dataset of encoded images
+    if records_dir is not None:
+        index = packed_index(records_dir, csv_path, image_paths, labels)
+        ds = record_dataset(records_dir, index, shuffle_buffer=shuffle_buffer)
+    else:
+        ds = shuffled_files(image_paths, labels)
+
+    # decode and preprocess
     ds = ds.map(
-        lambda path, label: (load_and_preprocess_image(path), label),
+        lambda image, label: (preprocess_image(image, fast_decode), label),
         num_parallel_calls=AUTOTUNE
     )
 
-    # shuffle, batch, and prefetch
-    ds = ds.shuffle(shuffle_buffer)
+    # batch and prefetch
     ds = ds.batch(batch_size)
     ds = ds.prefetch(AUTOTUNE)
 
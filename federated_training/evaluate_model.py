@@ -13,9 +13,15 @@ from pathlib import Path
 import pickle
 import logging
 
+from checkpoints import CheckpointStore
+from data_loader import decode_jpeg_for_size
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Decode JPEGs at reduced resolution before resizing; should match how the model was trained
+FAST_JPEG_DECODE = os.environ.get('FAST_JPEG_DECODE', 'false').lower() in ('1', 'true', 'yes')
+
 def create_model():
     """Create the same model architecture as train_local.py"""
     return tf.keras.Sequential([
@@ -25,11 +31,14 @@ def create_model():
         tf.keras.layers.Dense(1, activation="sigmoid")
     ])
 
-def load_image(img_path, size=(128, 128)):
-    """Load and preprocess a CheXpert image"""
+def load_image(img_path, size=(128, 128), fast_decode=False):
+    """Load and preprocess a CheXpert image (at reduced decode resolution with fast_decode)"""
     try:
         img = tf.io.read_file(img_path)
-        img = tf.image.decode_jpeg(img, channels=1)
+        if fast_decode:
+            img = decode_jpeg_for_size(img, size, channels=1)
+        else:
+            img = tf.image.decode_jpeg(img, channels=1)
         img = tf.image.resize(img, size)
         img = img / 255.0  # Normalize
         return img.numpy()
@@ -37,7 +46,7 @@ def load_image(img_path, size=(128, 128)):
         logger.warning(f"Failed to load {img_path}: {e}")
         return None
 
-def make_validation_dataset(csv_path, img_root, batch_size=32):
+def make_validation_dataset(csv_path, img_root, batch_size=32, fast_decode=False):
     """
     Load validation dataset from CheXpert CSV.
     Returns (images, labels) for Pleural Effusion classification.
@@ -60,7 +69,7 @@ def make_validation_dataset(csv_path, img_root, batch_size=32):
             skipped += 1
             continue
         
-        img = load_image(img_path)
+        img = load_image(img_path, fast_decode=fast_decode)
         if img is not None:
             images.append(img)
             labels.append(int(label))
@@ -80,8 +89,22 @@ def make_validation_dataset(csv_path, img_root, batch_size=32):
     
     return ds, labels
 
+def load_checkpoint_weights(checkpoint_dir):
+    """
+    Memory-map the newest global model checkpoint written by the aggregator.
+
+    Returns:
+        Per-layer read-only views over the mapped file, or None if there is no checkpoint
+    """
+    checkpoint = CheckpointStore(checkpoint_dir).load_latest(mmap=True)
+    if checkpoint is None:
+        return None
+    round_number, layout, flat = checkpoint
+    logger.info(f"Mapped global weights of round {round_number} from {checkpoint_dir}")
+    return layout.views(flat)
+
 def load_global_weights(weights_file):
-    """Load global weights from pickle file"""
+    """Load global weights from a legacy pickle file"""
     try:
         with open(weights_file, 'rb') as f:
             weights = pickle.load(f)
@@ -129,17 +152,18 @@ def main():
     # Paths
     chexpert_root = '/data/federated-learning-medical-images'  # Parent directory
     valid_csv = os.path.join(chexpert_root, 'CheXpert-v1.0/valid.csv')
+    checkpoint_dir = os.path.join(chexpert_root, 'CheXpert-v1.0/checkpoints')
     weights_file = os.path.join(chexpert_root, 'CheXpert-v1.0/global_model_weights.pkl')
     
-    # Check if weights file exists
-    if not os.path.exists(weights_file):
-        logger.warning(f"Weights file not found: {weights_file}")
+    # Check if weights exist (checkpoints, or a pickle from an older aggregator)
+    if not CheckpointStore(checkpoint_dir).rounds() and not os.path.exists(weights_file):
+        logger.warning(f"No checkpoint in {checkpoint_dir} and no weights file {weights_file}")
         logger.info("Make sure aggregator has saved final weights to this location.")
         sys.exit(1)
     
     # Load validation data
     logger.info("Loading validation dataset...")
-    validation_ds, true_labels = make_validation_dataset(valid_csv, chexpert_root)
+    validation_ds, true_labels = make_validation_dataset(valid_csv, chexpert_root, fast_decode=FAST_JPEG_DECODE)
     if validation_ds is None:
         logger.error("Failed to load validation data")
         sys.exit(1)
@@ -148,7 +172,9 @@ def main():
     logger.info("Creating model...")
     model = create_model()
     
-    weights = load_global_weights(weights_file)
+    weights = load_checkpoint_weights(checkpoint_dir)
+    if weights is None:
+        weights = load_global_weights(weights_file)
     if weights is None:
         sys.exit(1)
     
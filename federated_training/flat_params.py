@@ -0,0 +1,84 @@
+"""
+Flat parameter-vector layout shared by the aggregator and the clients.
+
+A model is held as one contiguous float32 vector; a FlatLayout records where each
+layer lives in it as (name, offset, shape). Per-layer arrays are views into the
+vector, so whole-model arithmetic is one vectorized operation over a single buffer
+while code that needs layers (model.set_weights, the per-tensor wire format) still
+gets them without copies.
+"""
+
+import numpy as np
+
+
+class FlatLayout:
+    """(name, offset, shape) index of a model's layers within one flat float32 vector."""
+
+    def __init__(self, shapes, names=None):
+        """
+        Args:
+            shapes: Layer shapes, in model order
+            names: Layer names (defaults to layer_0, layer_1, ...)
+        """
+        shapes = [tuple(int(dim) for dim in shape) for shape in shapes]
+        if names is None:
+            names = [f"layer_{i}" for i in range(len(shapes))]
+        self.entries = []
+        offset = 0
+        for name, shape in zip(names, shapes):
+            self.entries.append((name, offset, shape))
+            offset += int(np.prod(shape, dtype=np.int64))
+        self.size = offset
+
+    @classmethod
+    def from_weights(cls, weights, names=None):
+        """Layout of a list of per-layer arrays (e.g. model.get_weights())"""
+        return cls([np.shape(w) for w in weights], names)
+
+    @classmethod
+    def from_tensors(cls, tensors):
+        """Layout of the tensors of a ModelWeights message"""
+        return cls([tuple(tensor.shape) for tensor in tensors])
+
+    @property
+    def shapes(self):
+        return [shape for _, _, shape in self.entries]
+
+    @property
+    def names(self):
+        return [name for name, _, _ in self.entries]
+
+    def __eq__(self, other):
+        return isinstance(other, FlatLayout) and self.shapes == other.shapes
+
+    def __len__(self):
+        return len(self.entries)
+
+    def allocate(self, dtype=np.float32, fill=None):
+        """New flat vector for this layout (uninitialized unless `fill` is given)"""
+        if fill is None:
+            return np.empty(self.size, dtype=dtype)
+        return np.full(self.size, fill, dtype=dtype)
+
+    def views(self, flat):
+        """Per-layer views into `flat`, in model order"""
+        return [flat[offset:offset + int(np.prod(shape, dtype=np.int64))].reshape(shape)
+                for _, offset, shape in self.entries]
+
+    def flatten(self, weights, out=None):
+        """Copy per-layer arrays into a flat vector (`out`, or a new float32 one)"""
+        if out is None:
+            out = self.allocate()
+        for view, weight in zip(self.views(out), weights):
+            view[...] = weight
+        return out
+
+    def to_dict(self):
+        """JSON-serializable form of the index"""
+        return {'size': self.size,
+                'layers': [{'name': name, 'offset': offset, 'shape': list(shape)}
+                           for name, offset, shape in self.entries]}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls([layer['shape'] for layer in data['layers']], [layer['name'] for layer in data['layers']])
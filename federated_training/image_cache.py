@@ -0,0 +1,162 @@
+"""
+On-disk cache of decoded, resized training images.
+
+Decoding a full-resolution CheXpert JPEG and resizing it to IMAGE_SIZE gives the same
+tensor every epoch, so the first pass stores the result as uint8 in shard files and
+every later epoch (and run) reads it back instead of decoding again:
+    <cache root>/<key>/shard_00000.npy   up to shard_size images, (n, height, width, channels) uint8
+    <cache root>/<key>/labels.npy        labels of all cached images, in order
+    <cache root>/<key>/index.json        count, shard size and image shape; written last
+
+The key is a hash of the manifest (the client's CSV), the image size and anything
+else that changes the cached values, so editing the CSV or changing IMAGE_SIZE makes
+a new cache and the stale ones are removed. The shards are opened with
+np.load(mmap_mode='r'), so reading a batch is a copy out of the page cache.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+
+import numpy as np
+
+from checkpoints import atomic_write
+
+logger = logging.getLogger(__name__)
+
+# Bump when the cached values change meaning, so old caches are not reused
+# (2: labels come from the filtered manifest rows; version 1 caches can hold misaligned labels)
+CACHE_VERSION = 2
+# 2048 images of 128x128x1 is 32 MiB per shard
+DEFAULT_SHARD_SIZE = 2048
+
+
+def manifest_key(manifest_path, *settings):
+    """
+    Key of data derived from `manifest_path`.
+
+    Args:
+        manifest_path: File listing the images and labels (its content is hashed)
+        settings: Everything else the derived values depend on (image size, target label, ...)
+    """
+    digest = hashlib.sha1()
+    with open(manifest_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    digest.update(repr((CACHE_VERSION, settings)).encode())
+    return digest.hexdigest()[:16]
+
+
+class ImageCache:
+    """Sharded uint8 image cache for one manifest key."""
+
+    def __init__(self, root, key, shard_size=DEFAULT_SHARD_SIZE):
+        """
+        Args:
+            root: Directory holding the caches (one subdirectory per key)
+            key: Cache key, see manifest_key
+            shard_size: Images per shard file when writing
+        """
+        self.root = root
+        self.key = key
+        self.directory = os.path.join(root, key)
+        self.shard_size = shard_size
+        self.shards = None
+        self.labels = None
+
+    def _index_path(self):
+        return os.path.join(self.directory, 'index.json')
+
+    def _shard_path(self, shard):
+        return os.path.join(self.directory, f"shard_{shard:05d}.npy")
+
+    def is_complete(self):
+        """Whether a finished cache exists for this key"""
+        return os.path.exists(self._index_path())
+
+    def write(self, batches):
+        """
+        Build the cache from (images, labels) batches and remove caches of other keys.
+
+        Args:
+            batches: Iterable of (uint8 array (n, height, width, channels), labels (n,))
+
+        Returns:
+            Number of cached images
+        """
+        # Drop whatever an interrupted build left behind
+        shutil.rmtree(self.directory, ignore_errors=True)
+        os.makedirs(self.directory)
+        buffer = None
+        labels = []
+        filled = shard = count = 0
+        for images, batch_labels in batches:
+            images = np.asarray(images, dtype=np.uint8)
+            if buffer is None:
+                buffer = np.empty((self.shard_size,) + images.shape[1:], dtype=np.uint8)
+            labels.append(np.asarray(batch_labels, dtype=np.float32))
+            start = 0
+            while start < len(images):
+                take = min(len(images) - start, self.shard_size - filled)
+                buffer[filled:filled + take] = images[start:start + take]
+                filled += take
+                start += take
+                if filled == self.shard_size:
+                    self._write_shard(shard, buffer)
+                    shard += 1
+                    filled = 0
+            count += len(images)
+        if filled:
+            self._write_shard(shard, buffer[:filled])
+        labels = np.concatenate(labels) if labels else np.empty(0, dtype=np.float32)
+        atomic_write(os.path.join(self.directory, 'labels.npy'), lambda f: np.save(f, labels, allow_pickle=False))
+        index = {
+            'version': CACHE_VERSION,
+            'count': count,
+            'shard_size': self.shard_size,
+            'image_shape': list(buffer.shape[1:]) if buffer is not None else [],
+        }
+        atomic_write(self._index_path(), lambda f: f.write(json.dumps(index).encode()))
+        self._remove_stale()
+        logger.info(f"✓ Cached {count} images in {self.directory}")
+        return count
+
+    def _write_shard(self, shard, images):
+        atomic_write(self._shard_path(shard), lambda f: np.save(f, images, allow_pickle=False))
+
+    def _remove_stale(self):
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if name != self.key and os.path.exists(os.path.join(path, 'index.json')):
+                shutil.rmtree(path, ignore_errors=True)
+                logger.info(f"Removed stale image cache {path}")
+
+    def open(self):
+        """
+        Memory-map the shards of a complete cache.
+
+        Returns:
+            (number of images, image shape, labels)
+        """
+        with open(self._index_path()) as f:
+            index = json.load(f)
+        self.shard_size = index['shard_size']
+        num_shards = -(-index['count'] // self.shard_size)
+        self.shards = [np.load(self._shard_path(shard), mmap_mode='r', allow_pickle=False)
+                       for shard in range(num_shards)]
+        self.labels = np.load(os.path.join(self.directory, 'labels.npy'), allow_pickle=False)
+        if len(self.labels) != index['count'] or sum(len(s) for s in self.shards) != index['count']:
+            raise ValueError(f"Image cache {self.directory} does not match its index")
+        return index['count'], tuple(index['image_shape']), self.labels
+
+    def gather(self, indices):
+        """Copy the cached images at `indices` (positions in cache order) into one uint8 batch"""
+        indices = np.asarray(indices, dtype=np.int64)
+        shard_of, row_of = np.divmod(indices, self.shard_size)
+        out = np.empty((len(indices),) + self.shards[0].shape[1:], dtype=np.uint8)
+        for shard in np.unique(shard_of):
+            selected = shard_of == shard
+            out[selected] = self.shards[shard][row_of[selected]]
+        return out
@@ -0,0 +1,147 @@
+"""
+Packed TFRecord shards of a client's labelled training images.
+
+Reading thousands of small JPEGs from the shared volume costs an open and a small
+random read per image. Packing writes the encoded JPEG bytes and labels into a few
+large TFRecord shards, so an epoch is a handful of long sequential reads that
+tf.data interleaves in parallel:
+    <records root>/<key>/shard_00000.tfrecord   tf.train.Example with 'image' (JPEG bytes) and 'label'
+    <records root>/<key>/index.json             shard files and their record counts; written last
+
+The key comes from image_cache.manifest_key, so records packed from an older CSV
+are not used and are removed once the new ones are complete.
+
+Pack a client ahead of time with:
+    python3 record_shards.py /dataset/clients/client_0 [...]
+"""
+
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+
+import tensorflow as tf
+
+from checkpoints import atomic_write
+
+logger = logging.getLogger(__name__)
+
+# Bump when the packed contents or their order change, so older packs are not reused
+# (3: labels come from the filtered manifest rows; older packs can hold misaligned labels)
+RECORDS_VERSION = 3
+DEFAULT_NUM_SHARDS = 8
+# Shards read concurrently by interleave
+DEFAULT_CYCLE_LENGTH = 4
+# Read buffer per shard; large so each read is a long sequential one
+READ_BUFFER_BYTES = 8 * 1024 * 1024
+
+_FEATURES = {
+    'image': tf.io.FixedLenFeature([], tf.string),
+    'label': tf.io.FixedLenFeature([], tf.float32),
+}
+
+
+def _example(contents, label):
+    return tf.train.Example(features=tf.train.Features(feature={
+        'image': tf.train.Feature(bytes_list=tf.train.BytesList(value=[contents])),
+        'label': tf.train.Feature(float_list=tf.train.FloatList(value=[float(label)])),
+    }))
+
+
+def pack_records(paths, labels, root, key, num_shards=DEFAULT_NUM_SHARDS):
+    """
+    Write the images at `paths` with their labels into `num_shards` TFRecord shards.
+
+    The images are packed in a random order seeded by `key`, so each shard is a sample of
+    the whole client rather than a run of consecutive patients.
+
+    Args:
+        paths: Image files, in manifest order
+        labels: Label of each image
+        root: Directory holding the packed records (one subdirectory per key)
+        key: Manifest key, see image_cache.manifest_key
+
+    Returns:
+        The index: {'key', 'count', 'shards': [{'file', 'count'}, ...]}
+    """
+    directory = os.path.join(root, key)
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory)
+    pairs = list(zip(paths, labels))
+    random.Random(key).shuffle(pairs)
+    per_shard = -(-len(pairs) // max(1, num_shards))
+    shards = []
+    for shard, start in enumerate(range(0, len(pairs), max(1, per_shard))):
+        name = f"shard_{shard:05d}.tfrecord"
+        path = os.path.join(directory, name)
+        with tf.io.TFRecordWriter(f"{path}.tmp") as writer:
+            for image_path, label in pairs[start:start + per_shard]:
+                with open(image_path, 'rb') as f:
+                    writer.write(_example(f.read(), label).SerializeToString())
+        os.replace(f"{path}.tmp", path)
+        shards.append({'file': name, 'count': len(pairs[start:start + per_shard])})
+    index = {'key': key, 'count': len(pairs), 'shards': shards}
+    atomic_write(os.path.join(directory, 'index.json'), lambda f: f.write(json.dumps(index).encode()))
+
+    for name in os.listdir(root):
+        if name != key:
+            shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+    logger.info(f"✓ Packed {len(pairs)} images into {len(shards)} shards in {directory}")
+    return index
+
+
+def load_index(root, key):
+    """Index of the records packed under `key`, or None if there are none"""
+    try:
+        with open(os.path.join(root, key, 'index.json')) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def record_dataset(root, index, cycle_length=DEFAULT_CYCLE_LENGTH, shuffle_buffer=None):
+    """
+    Dataset of (JPEG bytes, label) read from packed shards.
+
+    Up to `cycle_length` shards are read concurrently and their records interleaved.
+
+    Shards are only read sequentially, so this is not a full per-epoch shuffle: the order
+    within each shard is the one chosen by pack_records, and an epoch can only change the
+    shard order and mix records within the shuffle buffer.
+
+    Args:
+        shuffle_buffer: If set, the shard order is shuffled every epoch and the interleaved
+            records pass through a shuffle buffer of this many encoded records
+    """
+    directory = os.path.join(root, index['key'])
+    files = [os.path.join(directory, shard['file']) for shard in index['shards']]
+    ds = tf.data.Dataset.from_tensor_slices(files)
+    if shuffle_buffer is not None:
+        ds = ds.shuffle(max(1, len(files)))
+    ds = ds.interleave(
+        lambda path: tf.data.TFRecordDataset(path, buffer_size=READ_BUFFER_BYTES),
+        cycle_length=max(1, min(cycle_length, len(files))),
+        num_parallel_calls=tf.data.AUTOTUNE,
+        deterministic=False,
+    )
+    if shuffle_buffer is not None:
+        ds = ds.shuffle(max(1, shuffle_buffer))
+    return ds.map(_parse, num_parallel_calls=tf.data.AUTOTUNE)
+
+
+def _parse(record):
+    example = tf.io.parse_single_example(record, _FEATURES)
+    return example['image'], example['label']
+
+
+if __name__ == '__main__':
+    from data_loader import TARGET_LABEL, read_manifest
+    from image_cache import manifest_key
+
+    logging.basicConfig(level=logging.INFO)
+    for client_path in sys.argv[1:]:
+        csv_path, paths, labels = read_manifest(client_path)
+        key = manifest_key(csv_path, TARGET_LABEL, RECORDS_VERSION)
+        pack_records(paths, labels, os.path.join(client_path, 'records'), key)
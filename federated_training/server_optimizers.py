@@ -0,0 +1,166 @@
+"""
+Server-side optimizers applied by the aggregator after each round (FedOpt).
+
+The averaged client model minus the current global model is treated as a
+pseudo-gradient and fed to a momentum or adaptive update instead of replacing the
+global model outright. All optimizer state lives in float32 arrays allocated once,
+on the first round, and updated in place. The aggregator passes its flat model vector
+(see flat_params) as a single layer, so each step is a handful of whole-model operations.
+"""
+
+import numpy as np
+
+SERVER_OPTIMIZERS = ('fedavg', 'fedavgm', 'fedadam', 'fedyogi')
+
+# Server learning rates that work out of the box; adaptive steps are ~lr per coordinate
+DEFAULT_SERVER_LR = {'fedavgm': 1.0, 'fedadam': 0.01, 'fedyogi': 0.01}
+
+
+class ServerOptimizer:
+    """
+    Base class: rewrites the averaged model into the next global model in place.
+
+    Subclasses implement `_direction(i, delta)`, which turns the pseudo-gradient of
+    layer i into the step direction (in place) and updates their state.
+    """
+
+    def __init__(self, lr):
+        """
+        Args:
+            lr: Server learning rate (step size applied to the direction)
+        """
+        self.lr = lr
+        self.delta = None  # per-layer pseudo-gradient buffers
+
+    def _allocate(self, shapes):
+        """Allocate the optimizer state for a model with these layer shapes"""
+        self.delta = [np.zeros(shape, dtype=np.float32) for shape in shapes]
+
+    def apply(self, global_weights, aggregated):
+        """
+        Replace `aggregated` (the round's averaged model) with the next global model.
+
+        Args:
+            global_weights: Current global model (left untouched)
+            aggregated: Averaged client model, overwritten layer by layer
+        """
+        if self.delta is None or [d.shape for d in self.delta] != [a.shape for a in aggregated]:
+            self._allocate([a.shape for a in aggregated])
+        for i, (current, layer_out) in enumerate(zip(global_weights, aggregated)):
+            delta = self.delta[i]
+            np.subtract(layer_out, current, out=delta)
+            self._direction(i, delta)
+            np.multiply(delta, self.lr, out=delta)
+            np.add(current, delta, out=layer_out)
+        return aggregated
+
+    def _direction(self, i, delta):
+        raise NotImplementedError
+
+
+class FedAvgM(ServerOptimizer):
+    """Server momentum: m = beta * m + delta, global += lr * m"""
+
+    def __init__(self, lr=1.0, momentum=0.9):
+        super().__init__(lr)
+        self.momentum = momentum
+        self.velocity = None
+
+    def _allocate(self, shapes):
+        super()._allocate(shapes)
+        self.velocity = [np.zeros(shape, dtype=np.float32) for shape in shapes]
+
+    def _direction(self, i, delta):
+        velocity = self.velocity[i]
+        np.multiply(velocity, self.momentum, out=velocity)
+        np.add(velocity, delta, out=velocity)
+        delta[...] = velocity
+
+
+class FedAdam(ServerOptimizer):
+    """
+    Adam on the pseudo-gradient (no bias correction, as in FedOpt):
+        m = beta1 * m + (1 - beta1) * delta
+        v = beta2 * v + (1 - beta2) * delta^2
+        global += lr * m / (sqrt(v) + tau)
+    """
+
+    def __init__(self, lr=0.01, beta1=0.9, beta2=0.99, tau=1e-3):
+        super().__init__(lr)
+        self.beta1 = beta1
+        self.beta2 = beta2
+        self.tau = tau
+        self.m = None
+        self.v = None
+        self.scratch = None
+
+    def _allocate(self, shapes):
+        super()._allocate(shapes)
+        self.m = [np.zeros(shape, dtype=np.float32) for shape in shapes]
+        # v starts at tau^2 so the first steps are not blown up by a tiny denominator
+        self.v = [np.full(shape, self.tau ** 2, dtype=np.float32) for shape in shapes]
+        self.scratch = [np.empty(shape, dtype=np.float32) for shape in shapes]
+
+    def _update_second_moment(self, i, squared):
+        v = self.v[i]
+        v *= self.beta2
+        squared *= 1.0 - self.beta2
+        v += squared
+
+    def _direction(self, i, delta):
+        m, v, scratch = self.m[i], self.v[i], self.scratch[i]
+        m *= self.beta1
+        np.multiply(delta, 1.0 - self.beta1, out=scratch)
+        m += scratch
+        np.square(delta, out=scratch)
+        self._update_second_moment(i, scratch)
+        np.sqrt(v, out=scratch)
+        scratch += self.tau
+        np.divide(m, scratch, out=delta)
+
+
+class FedYogi(FedAdam):
+    """
+    Yogi on the pseudo-gradient: like FedAdam, but v moves additively towards delta^2,
+        v = v - (1 - beta2) * delta^2 * sign(v - delta^2)
+    which keeps the effective step size from growing abruptly.
+    """
+
+    def __init__(self, lr=0.01, beta1=0.9, beta2=0.99, tau=1e-3):
+        super().__init__(lr, beta1, beta2, tau)
+        self.sign = None
+
+    def _allocate(self, shapes):
+        super()._allocate(shapes)
+        self.sign = [np.empty(shape, dtype=np.float32) for shape in shapes]
+
+    def _update_second_moment(self, i, squared):
+        v, sign = self.v[i], self.sign[i]
+        np.subtract(v, squared, out=sign)
+        np.sign(sign, out=sign)
+        squared *= sign
+        squared *= 1.0 - self.beta2
+        v -= squared
+
+
+def make_server_optimizer(name='fedavg', lr=None, momentum=0.9, beta1=0.9, beta2=0.99, tau=1e-3):
+    """
+    Build the server optimizer applied after each round.
+
+    Args:
+        name: 'fedavg' (plain replacement, returns None), 'fedavgm', 'fedadam' or 'fedyogi'
+        lr: Server learning rate; None uses DEFAULT_SERVER_LR for the optimizer
+        momentum: FedAvgM momentum
+        beta1, beta2, tau: FedAdam/FedYogi moment decay rates and adaptivity constant
+    """
+    if name == 'fedavg':
+        return None
+    if name not in SERVER_OPTIMIZERS:
+        raise ValueError(f"Unknown server optimizer: {name} (expected one of {SERVER_OPTIMIZERS})")
+    if lr is None:
+        lr = DEFAULT_SERVER_LR[name]
+    if name == 'fedavgm':
+        return FedAvgM(lr, momentum)
+    if name == 'fedadam':
+        return FedAdam(lr, beta1, beta2, tau)
+    return FedYogi(lr, beta1, beta2, tau)
@@ -0,0 +1,142 @@
+"""
+Weight exchange through the volume shared by the clients and the aggregator.
+
+Instead of putting its weights in the gRPC message, a client writes them as one flat
+float32 .npy file on the shared volume and sends a ModelWeights whose tensors only
+carry their shapes, plus a SharedPayload with the file's path, size and CRC32. The
+aggregator memory-maps the file and hands the collectors a MappedModelWeights, which
+looks like a ModelWeights whose raw_data are views into the mapping, so the update is
+folded into the aggregate straight from the page cache without protobuf decoding.
+
+The aggregator only maps, and then removes, files that resolve to the sending client's
+own `{client_id}_round{N}.npy` inside its shared updates directory, so a message cannot
+point it at (and delete) anything else on the volume.
+"""
+
+import os
+import re
+import zlib
+
+import numpy as np
+
+import weights_transmitting_pb2
+from checkpoints import atomic_write
+from flat_params import FlatLayout
+
+
+def write_shared_update(weights, directory, client_id, round_number=0, num_examples=0):
+    """
+    Write a client's weights to the shared volume and build the ModelWeights pointing at them.
+
+    Args:
+        weights: Per-layer arrays (e.g. model.get_weights())
+        directory: Shared directory the aggregator can read (created if missing)
+
+    Returns:
+        ModelWeights with tensor shapes and the SharedPayload set, ready for TransmitWeights
+    """
+    layout = FlatLayout.from_weights(weights)
+    flat = layout.flatten(weights)
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{client_id}_round{round_number:06d}.npy")
+    atomic_write(path, lambda f: np.save(f, flat, allow_pickle=False))
+
+    model_weights_msg = weights_transmitting_pb2.ModelWeights()
+    model_weights_msg.client_id = client_id
+    model_weights_msg.round_number = round_number
+    model_weights_msg.num_examples = num_examples
+    for shape in layout.shapes:
+        tensor = model_weights_msg.tensors.add()
+        tensor.shape.extend(shape)
+        tensor.dtype = weights_transmitting_pb2.FLOAT32
+    model_weights_msg.shared.path = path
+    model_weights_msg.shared.size = flat.nbytes
+    model_weights_msg.shared.crc32 = zlib.crc32(flat)
+    return model_weights_msg
+
+
+class MappedTensor:
+    """WeightTensor stand-in whose raw_data is a view into a mapped file"""
+
+    data = ()
+    scale = 0.0
+    sparse = False
+    indices = b''
+
+    def __init__(self, shape, raw_data):
+        self.shape = shape
+        self.raw_data = raw_data
+        self.dtype = weights_transmitting_pb2.FLOAT32
+
+
+class MappedModelWeights:
+    """ModelWeights stand-in for an update read from the shared volume"""
+
+    def __init__(self, model_weights_msg, tensors):
+        self.client_id = model_weights_msg.client_id
+        self.round_number = model_weights_msg.round_number
+        self.num_examples = model_weights_msg.num_examples
+        self.is_delta = model_weights_msg.is_delta
+        self.tensors = tensors
+
+
+def _update_path(model_weights_msg, directory):
+    """
+    Resolved path of a shared update, checked to be the sender's own file in `directory`.
+
+    Raises:
+        ValueError: If the path resolves outside `directory` or is not named
+                    `{client_id}_round{N}.npy` for the message's client_id
+    """
+    path = os.path.realpath(model_weights_msg.shared.path)
+    if os.path.dirname(path) != os.path.realpath(directory):
+        raise ValueError(f"Shared update '{model_weights_msg.shared.path}' is outside {directory}")
+    pattern = rf"{re.escape(model_weights_msg.client_id)}_round\d+\.npy"
+    if not re.fullmatch(pattern, os.path.basename(path)):
+        raise ValueError(f"Shared update '{model_weights_msg.shared.path}' is not a file "
+                         f"of client '{model_weights_msg.client_id}'")
+    return path
+
+
+def map_shared_update(model_weights_msg, directory):
+    """
+    Memory-map the file of a shared-volume update and check it against its SharedPayload.
+
+    The file is unlinked once mapped (the mapping stays valid), and also when it is
+    rejected, so nothing is left behind on the volume. Paths that are not the sender's
+    own update file are rejected without touching them.
+
+    Args:
+        model_weights_msg: ModelWeights with the SharedPayload set
+        directory: Shared updates directory the file must be in
+
+    Returns:
+        MappedModelWeights usable wherever the collectors take a ModelWeights
+
+    Raises:
+        ValueError: If the path is not allowed, or the file is missing or does not match the message
+    """
+    shared = model_weights_msg.shared
+    path = _update_path(model_weights_msg, directory)
+    try:
+        try:
+            flat = np.load(path, mmap_mode='r', allow_pickle=False)
+        except (OSError, ValueError) as e:
+            raise ValueError(f"Cannot map shared update '{path}': {e}")
+        layout = FlatLayout.from_tensors(model_weights_msg.tensors)
+        if flat.dtype != np.dtype('<f4') or flat.shape != (layout.size,) or flat.nbytes != shared.size:
+            raise ValueError(f"Shared update '{path}' does not match the layout sent with it")
+        if zlib.crc32(flat) != shared.crc32:
+            raise ValueError(f"Shared update '{path}' failed its CRC32 check")
+    finally:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    buffer = memoryview(flat).cast('B')
+    tensors = []
+    for _, offset, shape in layout.entries:
+        size = int(np.prod(shape, dtype=np.int64)) * 4
+        tensors.append(MappedTensor(shape, buffer[offset * 4:offset * 4 + size]))
+    return MappedModelWeights(model_weights_msg, tensors)
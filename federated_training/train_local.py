@@ -1,12 +1,15 @@
 import os
+import time
 import tensorflow as tf
 import grpc
-import numpy as np
 import logging
-import weights_transmitting_pb2
+from concurrent.futures import ThreadPoolExecutor
 import weights_transmitting_pb2_grpc
 
 from data_loader import make_dataset
+from weights_codec import DeltaCompressor, convert_weights_to_proto, proto_to_weights
+from weights_client import upload_weights, wait_for_global_model
+from shared_payload import write_shared_update
 from pod_recognisition import get_client_id
 
 # Setup logging
@@ -21,98 +24,259 @@ def create_model():
         tf.keras.layers.Dense(1, activation="sigmoid")
     ])
 
-def convert_weights_to_proto(weights, client_id="unknown"):
-    """Convert model weights to a protobuf message."""
-    model_weights_msg = weights_transmitting_pb2.ModelWeights()
-    model_weights_msg.client_id = client_id
-    for weight in weights:
-        tensor = weights_transmitting_pb2.WeightTensor()
-        tensor.data.extend(weight.flatten().tolist())
-        tensor.shape.extend(weight.shape)
-        model_weights_msg.tensors.append(tensor)
-    return model_weights_msg
-
-def proto_to_weights(msg):
-    """Convert protobuf ModelWeights back to numpy arrays."""
-    weights = []
-    for tensor in msg.tensors:
-        array = np.array(tensor.data, dtype=np.float32).reshape(tensor.shape)
-        weights.append(array)
-    return weights
-
 # Configuration
 # Updated for real-scale test: 12 rounds x 4 epochs = 48 total epochs per client
 NUM_ROUNDS = 12
 EPOCHS_PER_ROUND = 4
 LOCAL_BATCH_SIZE = int(os.environ.get('LOCAL_BATCH_SIZE', '8'))
-SHUFFLE_BUFFER = int(os.environ.get('SHUFFLE_BUFFER', '32'))
-AGGREGATOR_ADDRESS = 'aggregator-service:50051'
+# Encoded (not decoded) records mixed after reading packed shards; files and cached images are shuffled by index
+# over the whole dataset instead
+SHUFFLE_BUFFER = int(os.environ.get('SHUFFLE_BUFFER', '256'))
+UPLOAD_CHUNK_BYTES = int(os.environ.get('UPLOAD_CHUNK_BYTES', str(1024 * 1024)))
+# Pack the client's JPEGs into a few large TFRecord shards under its directory and read those instead of the files.
+# Off by default: with IMAGE_CACHE the records would only be read once, to build the cache, yet double the disk use
+PACKED_RECORDS = os.environ.get('PACKED_RECORDS', 'false').lower() in ('1', 'true', 'yes')
+# Decode each image once into a uint8 cache under the client's directory and train from it afterwards
+IMAGE_CACHE = os.environ.get('IMAGE_CACHE', 'true').lower() in ('1', 'true', 'yes')
+# Decode JPEGs at 1/2, 1/4 or 1/8 resolution before resizing (see benchmark_decode.py)
+FAST_JPEG_DECODE = os.environ.get('FAST_JPEG_DECODE', 'false').lower() in ('1', 'true', 'yes')
+GLOBAL_MODEL_TIMEOUT = float(os.environ.get('GLOBAL_MODEL_TIMEOUT', '600'))
+# Batches run per compiled call (0: a whole epoch per call); metrics are read back once per call
+STEPS_PER_CALL = int(os.environ.get('STEPS_PER_CALL', '0'))
+# XLA-compile the training step (also on CPU)
+XLA_JIT = os.environ.get('XLA_JIT', 'false').lower() in ('1', 'true', 'yes')
+# 'fp16' or 'int8' sends the quantized difference from the round's global model, 'topk' only its
+# TOPK_FRACTION largest-magnitude entries per tensor (both with error feedback); 'none' sends full float32 weights
+UPDATE_COMPRESSION = os.environ.get('UPDATE_COMPRESSION', 'none')
+TOPK_FRACTION = float(os.environ.get('TOPK_FRACTION', '0.01'))
+# 'grpc' uploads the weights through the aggregator connection; 'shared' writes them to SHARED_UPDATES_DIR on the
+# volume shared with the aggregator and only sends the path (UPDATE_COMPRESSION does not apply)
+WEIGHT_TRANSPORT = os.environ.get('WEIGHT_TRANSPORT', 'grpc')
+SHARED_UPDATES_DIR = os.environ.get('SHARED_UPDATES_DIR', '/dataset/updates')
+# Upload the weights and prefetch the next global model on a background thread while the next round's input
+# pipeline warms up; 'false' runs the exchange inline as before
+OVERLAP_COMMUNICATION = os.environ.get('OVERLAP_COMMUNICATION', 'true').lower() in ('1', 'true', 'yes')
+# Root aggregator, or the edge aggregator of this site's group in a two-tier topology
+AGGREGATOR_ADDRESS = os.environ.get('AGGREGATOR_ADDRESS', 'aggregator-service:50051')
 
 # Setup
 root = os.environ['CLIENT_DATA_ROOT']
 pod_name = os.environ['POD_NAME']
 client_id = pod_name.split('-')[-1]
+client_path = f"{root}/clients/client_{client_id}"
 ds = make_dataset(
-    f"{root}/clients/client_{client_id}",
+    client_path,
     batch_size=LOCAL_BATCH_SIZE,
     shuffle_buffer=SHUFFLE_BUFFER,
+    cache_dir=os.path.join(client_path, 'image_cache') if IMAGE_CACHE else None,
+    fast_decode=FAST_JPEG_DECODE,
+    records_dir=os.path.join(client_path, 'records') if PACKED_RECORDS else None,
 )
 
 logger.info(f"Client {client_id} starting federated training for {NUM_ROUNDS} rounds")
-logger.info(f"Training config: batch_size={LOCAL_BATCH_SIZE}, shuffle_buffer={SHUFFLE_BUFFER}")
+logger.info(f"Training config: batch_size={LOCAL_BATCH_SIZE}, shuffle_buffer={SHUFFLE_BUFFER}, "
+            f"packed_records={PACKED_RECORDS}, image_cache={IMAGE_CACHE}, fast_jpeg_decode={FAST_JPEG_DECODE}, update_compression={UPDATE_COMPRESSION}, topk_fraction={TOPK_FRACTION}, "
+            f"weight_transport={WEIGHT_TRANSPORT}, steps_per_call={STEPS_PER_CALL}, xla_jit={XLA_JIT}, "
+            f"overlap_communication={OVERLAP_COMMUNICATION}")
 
 # Initialize model
 model = create_model()
 optimizer = tf.keras.optimizers.Adam(learning_rate=1e-3)
 loss_fn = tf.keras.losses.BinaryCrossentropy()
 
+@tf.function(jit_compile=XLA_JIT)
+def train_step(x, y):
+    with tf.GradientTape() as tape:
+        logits = model(x, training=True)
+        loss = loss_fn(y, logits)
+    grads = tape.gradient(loss, model.trainable_variables)
+    optimizer.apply_gradients(zip(grads, model.trainable_variables))
+    return loss
+
+@tf.function
+def train_steps(iterator, max_steps):
+    """Run up to max_steps batches from iterator in one graph call, summing the loss on-device"""
+    loss_sum = tf.constant(0.0)
+    num_batches = tf.constant(0)
+    batch_examples = tf.constant(0)
+    for _ in tf.range(max_steps):
+        batch = iterator.get_next_as_optional()
+        if not batch.has_value():
+            break
+        x, y = batch.get_value()
+        loss_sum += train_step(x, y)
+        num_batches += 1
+        batch_examples += tf.shape(x)[0]
+    return loss_sum, num_batches, batch_examples
+
+def train_epoch(iterator, first_batch=None):
+    """
+    Train on one pass over a dataset iterator, STEPS_PER_CALL batches per compiled call.
+
+    Args:
+        iterator: Fresh iterator over the training dataset
+        first_batch: Optional already pulled from `iterator` (see warm_up_input)
+
+    Returns:
+        (average loss, number of batches, number of examples)
+    """
+    max_steps = STEPS_PER_CALL if STEPS_PER_CALL > 0 else 2**31 - 1
+    total_loss, total_batches, total_examples = 0.0, 0, 0
+    if first_batch is not None and first_batch.has_value():
+        x, y = first_batch.get_value()
+        total_loss += float(train_step(x, y))
+        total_batches += 1
+        total_examples += int(x.shape[0])
+    while True:
+        loss_sum, num_batches, batch_examples = train_steps(iterator, tf.constant(max_steps))
+        # The only host sync: once per call, not once per batch
+        num_batches = int(num_batches)
+        total_loss += float(loss_sum)
+        total_batches += num_batches
+        total_examples += int(batch_examples)
+        if num_batches < max_steps:
+            break
+    return total_loss / max(1, total_batches), total_batches, total_examples
+
+def warm_up_input():
+    """
+    Start a new pass over the dataset and wait for its first batch.
+
+    Reads the first records and starts the map/prefetch workers, which keep going in the
+    background; meant to run while the communication thread is still busy.
+
+    Returns:
+        (iterator, first batch as a tf.experimental.Optional)
+    """
+    iterator = iter(ds)
+    return iterator, iterator.get_next_as_optional()
+
+compressor = DeltaCompressor(UPDATE_COMPRESSION, topk_fraction=TOPK_FRACTION) if UPDATE_COMPRESSION != 'none' else None
+# Global model the current round started from; compressed updates are sent relative to it
+base_weights = None
+
 # Connect to aggregator
 channel = grpc.insecure_channel(AGGREGATOR_ADDRESS)
 stub = weights_transmitting_pb2_grpc.SendWeightsStub(channel)
 
+# Round of the global model the local weights were last loaded from (-1: own initialization).
+# Uploads contribute to the next round; in async mode that version may already be out.
+model_round = -1
+# Local training examples, counted during the first epoch and reported with every upload for weighted FedAvg
+num_examples = 0
+
+def exchange_weights(weights, upload_round, wait_round):
+    """
+    Send one round's weights to the aggregator, then wait for the next global model.
+
+    Runs on the communication thread; uses the compressor and base_weights, which the
+    training loop leaves alone until the exchange has finished.
+
+    Args:
+        weights: Local weights at the end of the round (numpy copies)
+        upload_round: Round the upload contributes to
+        wait_round: Round of the global model to prefetch, or None to only upload
+
+    Returns:
+        (ModelWeights of the global model or None, decoded weights or None, timings in seconds)
+    """
+    timings = {'upload': 0.0, 'wait': 0.0}
+    start = time.perf_counter()
+    try:
+        if WEIGHT_TRANSPORT == 'shared':
+            model_weights_msg = write_shared_update(weights, SHARED_UPDATES_DIR, client_id,
+                                                    round_number=upload_round, num_examples=num_examples)
+            stub.TransmitWeights(model_weights_msg)
+            logger.info(f"✓ Sent weights to aggregator for round {upload_round} "
+                        f"via {model_weights_msg.shared.path} ({model_weights_msg.shared.size} bytes)")
+        else:
+            if compressor is not None and base_weights is not None:
+                model_weights_msg = compressor.compress(weights, base_weights, client_id, round_number=upload_round)
+            else:
+                # Nothing to take a delta against before the first global model
+                model_weights_msg = convert_weights_to_proto(weights, client_id, round_number=upload_round)
+            model_weights_msg.num_examples = num_examples
+            upload_weights(stub, model_weights_msg, chunk_size=UPLOAD_CHUNK_BYTES)
+            logger.info(f"✓ Sent weights to aggregator for round {upload_round} "
+                        f"({model_weights_msg.ByteSize()} bytes)")
+    except Exception as e:
+        logger.error(f"Failed to send weights: {e}")
+    timings['upload'] = time.perf_counter() - start
+    if wait_round is None:
+        return None, None, timings
+
+    start = time.perf_counter()
+    global_weights_msg, global_weights = None, None
+    try:
+        logger.info(f"Waiting for global weights of round {wait_round}...")
+        global_weights_msg = wait_for_global_model(stub, wait_round, timeout=GLOBAL_MODEL_TIMEOUT)
+        if global_weights_msg.tensors and global_weights_msg.round_number >= wait_round:
+            global_weights = proto_to_weights(global_weights_msg)
+    except Exception as e:
+        logger.error(f"Failed to get global weights: {e}")
+    timings['wait'] = time.perf_counter() - start
+    return global_weights_msg, global_weights, timings
+
+# Single worker: exchanges never overlap each other, only training and input warm-up
+comm_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='comm') if OVERLAP_COMMUNICATION else None
+# Exchange started at the end of the previous round (a Future, or the finished result when run inline)
+pending_exchange = None
+
+def finish_exchange():
+    """Block until the pending exchange is done and log how much of it was hidden behind local work"""
+    wait_start = time.perf_counter()
+    result = pending_exchange.result() if comm_executor is not None else pending_exchange
+    timings = result[2]
+    communication = timings['upload'] + timings['wait']
+    # Run inline, the whole exchange already held up training
+    blocked = time.perf_counter() - wait_start if comm_executor is not None else communication
+    logger.info(f"Communication: {timings['upload']:.2f}s upload, {timings['wait']:.2f}s waiting for the global model; "
+                f"training blocked {blocked:.2f}s ({max(0.0, communication - blocked):.2f}s overlapped)")
+    return result
+
 # Federated learning rounds
 for round_num in range(NUM_ROUNDS):
     logger.info(f"=== Round {round_num + 1}/{NUM_ROUNDS} ===")
+    round_start = time.perf_counter()
+    # Warm up the input pipeline while the previous round's exchange may still be running
+    iterator, first_batch = warm_up_input()
     
-    # 1. Pull global weights if not first round
-    if round_num > 0:
-        try:
-            logger.info("Pulling global weights from aggregator...")
-            global_weights_msg = stub.GetGlobalWeights(
-                weights_transmitting_pb2.GetWeightsRequest(round_number=round_num)
-            )
-            if global_weights_msg.tensors:
-                global_weights = proto_to_weights(global_weights_msg)
-                model.set_weights(global_weights)
-                logger.info(f"✓ Loaded global weights from round {round_num - 1}")
-            else:
-                logger.warning("Received empty global weights")
-        except Exception as e:
-            logger.error(f"Failed to get global weights: {e}")
+    # 1. Pick up the global weights prefetched at the end of the previous round
+    if pending_exchange is not None:
+        global_weights_msg, global_weights, _ = finish_exchange()
+        pending_exchange = None
+        if global_weights is not None:
+            model.set_weights(global_weights)
+            model_round = global_weights_msg.round_number
+            base_weights = global_weights
+            logger.info(f"✓ Loaded global weights from round {model_round}")
+        elif global_weights_msg is not None and not global_weights_msg.tensors:
+            logger.warning("Received empty global weights")
+        elif global_weights_msg is not None:
+            logger.warning(f"Round {model_round + 1} not published in time, keeping local weights")
     
     # 2. Train locally for EPOCHS_PER_ROUND
     for epoch in range(EPOCHS_PER_ROUND):
-        total_loss = 0.0
-        num_batches = 0
-        for x, y in ds:
-            with tf.GradientTape() as tape:
-                logits = model(x, training=True)
-                loss = loss_fn(y, logits)
-            grads = tape.gradient(loss, model.trainable_variables)
-            optimizer.apply_gradients(zip(grads, model.trainable_variables))
-            total_loss += loss.numpy()
-            num_batches += 1
-        avg_loss = total_loss / max(1, num_batches)
-        logger.info(f"Round {round_num + 1}, Epoch {epoch + 1}/{EPOCHS_PER_ROUND}: Loss = {avg_loss:.6f}")
+        epoch_start = time.perf_counter()
+        avg_loss, num_batches, epoch_examples = train_epoch(*warm_up_input()) if epoch else train_epoch(iterator, first_batch)
+        epoch_seconds = time.perf_counter() - epoch_start
+        if round_num == 0 and epoch == 0:
+            num_examples = epoch_examples
+        logger.info(f"Round {round_num + 1}, Epoch {epoch + 1}/{EPOCHS_PER_ROUND}: Loss = {avg_loss:.6f} "
+                    f"({epoch_examples / max(epoch_seconds, 1e-9):.1f} images/sec)")
     
-    # 3. Send updated weights to aggregator
-    try:
-        weights = model.get_weights()
-        model_weights_msg = convert_weights_to_proto(weights, client_id)
-        stub.TransmitWeights(model_weights_msg)
-        logger.info(f"✓ Sent weights to aggregator at end of round {round_num + 1}")
-    except Exception as e:
-        logger.error(f"Failed to send weights: {e}")
+    # 3. Send updated weights to aggregator and prefetch the next global model (none after the last round)
+    wait_round = model_round + 1 if round_num + 1 < NUM_ROUNDS else None
+    exchange_args = (model.get_weights(), model_round + 1, wait_round)
+    if comm_executor is not None:
+        pending_exchange = comm_executor.submit(exchange_weights, *exchange_args)
+    else:
+        pending_exchange = exchange_weights(*exchange_args)
+    logger.info(f"Round {round_num + 1} local work took {time.perf_counter() - round_start:.2f}s")
 
-logger.info("Federated training complete")
+if pending_exchange is not None:
+    finish_exchange()
+if comm_executor is not None:
+    comm_executor.shutdown()
 
+logger.info("Federated training complete")
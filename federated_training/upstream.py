@@ -0,0 +1,60 @@
+"""
+Link from an edge aggregator to the root aggregator (two-tier aggregation).
+
+An edge aggregator collects the updates of its site group like any aggregator, but
+instead of publishing its average it forwards it upstream as one update carrying the
+group's total num_examples, then publishes the root's global model to its clients.
+The root sees one sample-weighted update per edge, so its FedAvg over the edges equals
+FedAvg over all sites.
+"""
+
+import logging
+import time
+
+import grpc
+
+import weights_transmitting_pb2_grpc
+from weights_client import DEFAULT_CHUNK_BYTES, upload_weights, wait_for_global_model
+from weights_codec import convert_weights_to_proto
+
+logger = logging.getLogger(__name__)
+
+
+class UpstreamLink:
+    """Forwards an edge's aggregated updates to the root and fetches the root's global models."""
+
+    def __init__(self, address, edge_id, chunk_size=DEFAULT_CHUNK_BYTES, wait_timeout=600.0, retry_delay=5.0):
+        """
+        Args:
+            address: host:port of the root (or next-tier) aggregator
+            edge_id: client_id this edge reports upstream under
+            chunk_size: Bytes per chunk of the upstream upload
+            wait_timeout: Seconds per long-poll for the root's global model
+            retry_delay: Seconds to wait before polling again after the root was unreachable
+        """
+        self.address = address
+        self.edge_id = edge_id
+        self.chunk_size = chunk_size
+        self.wait_timeout = wait_timeout
+        self.retry_delay = retry_delay
+        self.channel = grpc.insecure_channel(address)
+        self.stub = weights_transmitting_pb2_grpc.SendWeightsStub(self.channel)
+
+    def forward(self, round_number, weights, num_examples):
+        """Upload the edge's aggregate of `round_number`, weighted by its clients' total examples"""
+        model_weights_msg = convert_weights_to_proto(weights, self.edge_id, round_number=round_number)
+        model_weights_msg.num_examples = num_examples
+        upload_weights(self.stub, model_weights_msg, chunk_size=self.chunk_size)
+        logger.info(f"✓ Forwarded round {round_number} aggregate ({num_examples} examples) to {self.address}")
+
+    def wait_for_round(self, round_number):
+        """Block until the root publishes the global model of `round_number` (or a later one) and return it"""
+        while True:
+            try:
+                model_weights_msg = wait_for_global_model(self.stub, round_number, timeout=self.wait_timeout)
+                if model_weights_msg.tensors and model_weights_msg.round_number >= round_number:
+                    return model_weights_msg
+                logger.warning(f"Root has not published round {round_number} yet, still waiting")
+            except grpc.RpcError as e:
+                logger.warning(f"Waiting for round {round_number} from {self.address} failed: {e.code()}, retrying")
+                time.sleep(self.retry_delay)
@@ -0,0 +1,107 @@
+"""
+Client-side transfer helpers for talking to the aggregator.
+"""
+
+import time
+import uuid
+import logging
+
+import grpc
+
+import weights_transmitting_pb2
+
+logger = logging.getLogger(__name__)
+
+# Stay well under gRPC's default 4 MB message limit
+DEFAULT_CHUNK_BYTES = 1024 * 1024
+# The aggregator refused the upload itself; sending it again cannot succeed
+NON_RETRYABLE_CODES = (grpc.StatusCode.INVALID_ARGUMENT, grpc.StatusCode.OUT_OF_RANGE)
+
+
+class UploadRejectedError(RuntimeError):
+    """The aggregator received an upload but could not use the update in it."""
+
+
+def _finished(upload_id, status):
+    """True if `status` reports the upload processed; raises if the update was rejected"""
+    if status.complete and status.rejected:
+        raise UploadRejectedError(f"Upload '{upload_id}' was rejected by the aggregator: {status.error}")
+    return status.complete
+
+
+def _iter_chunks(upload_id, client_id, payload, offset, chunk_size):
+    """Yield WeightsChunk messages covering payload[offset:]"""
+    total_size = len(payload)
+    while offset < total_size:
+        end = min(offset + chunk_size, total_size)
+        yield weights_transmitting_pb2.WeightsChunk(
+            upload_id=upload_id,
+            client_id=client_id,
+            offset=offset,
+            total_size=total_size,
+            data=payload[offset:end].tobytes(),
+        )
+        offset = end
+
+
+def upload_weights(stub, model_weights_msg, chunk_size=DEFAULT_CHUNK_BYTES, max_retries=5, retry_delay=2.0):
+    """
+    Upload a ModelWeights message through the chunked UploadWeights stream.
+
+    The message is serialized once and streamed in `chunk_size` pieces. When the stream
+    fails, the aggregator is asked how many bytes it committed and the upload resumes
+    from there under the same upload_id instead of starting over.
+
+    Returns:
+        The final UploadStatus from the aggregator
+
+    Raises:
+        UploadRejectedError: If the aggregator received the update but rejected it
+        grpc.RpcError: On a non-retryable status (INVALID_ARGUMENT, OUT_OF_RANGE)
+    """
+    payload = memoryview(model_weights_msg.SerializeToString())
+    upload_id = f"{model_weights_msg.client_id}-{uuid.uuid4().hex}"
+    offset = 0
+
+    for attempt in range(max_retries + 1):
+        try:
+            status = stub.UploadWeights(
+                _iter_chunks(upload_id, model_weights_msg.client_id, payload, offset, chunk_size)
+            )
+            if _finished(upload_id, status):
+                return status
+            offset = status.committed_offset
+        except grpc.RpcError as e:
+            if e.code() in NON_RETRYABLE_CODES:
+                logger.error(f"Upload '{upload_id}' refused by the aggregator: {e.code()} {e.details()}")
+                raise
+            logger.warning(f"Upload '{upload_id}' interrupted at attempt {attempt + 1}: {e.code()}")
+            time.sleep(retry_delay)
+            try:
+                status = stub.GetUploadStatus(weights_transmitting_pb2.UploadStatusRequest(upload_id=upload_id))
+                if _finished(upload_id, status):
+                    return status
+                offset = status.committed_offset
+            except grpc.RpcError:
+                # Aggregator still unreachable, retry from the last offset we know about
+                pass
+        logger.info(f"Resuming upload '{upload_id}' from byte {offset}/{len(payload)}")
+
+    raise RuntimeError(f"Upload '{upload_id}' did not complete after {max_retries + 1} attempts")
+
+
+def wait_for_global_model(stub, round_number, timeout=600.0):
+    """
+    Block until the aggregator publishes the global model of `round_number`.
+
+    Returns:
+        The ModelWeights received; its round_number is older than requested if the
+        aggregator timed out, and it is empty if no model was published yet
+    """
+    request = weights_transmitting_pb2.GetWeightsRequest(
+        round_number=round_number,
+        tensor_encoding=weights_transmitting_pb2.RAW_BYTES,
+        timeout_seconds=timeout,
+    )
+    # Leave the aggregator time to answer with its fallback before the call deadline hits
+    return stub.WaitForGlobalModel(request, timeout=timeout + 30)
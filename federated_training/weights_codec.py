@@ -0,0 +1,281 @@
+"""
+Conversion between numpy weight arrays and the WeightTensor/ModelWeights protobuf messages.
+
+Tensors are sent as a single raw little-endian buffer (`raw_data` + `dtype`) and decoded
+with np.frombuffer, so no per-element Python work is done on either side. The legacy
+`repeated float data` encoding is still decoded, and can still be produced for old clients.
+
+Client updates can also be sent as lossy-compressed deltas, quantized or top-k sparse
+(see DeltaCompressor); the aggregator folds those into its buffers with accumulate_tensor
+without a dense copy.
+"""
+
+import numpy as np
+
+import weights_transmitting_pb2
+from flat_params import FlatLayout
+
+# Wire dtype enum <-> little-endian numpy dtype
+_NUMPY_DTYPES = {
+    weights_transmitting_pb2.FLOAT32: np.dtype('<f4'),
+    weights_transmitting_pb2.FLOAT16: np.dtype('<f2'),
+    weights_transmitting_pb2.FLOAT64: np.dtype('<f8'),
+    weights_transmitting_pb2.INT8: np.dtype('i1'),
+}
+_WIRE_DTYPES = {dtype: wire for wire, dtype in _NUMPY_DTYPES.items()}
+_INDEX_DTYPE = np.dtype('<u4')
+
+
+def encode_tensor(array, encoding=weights_transmitting_pb2.RAW_BYTES):
+    """
+    Encode a numpy array as a WeightTensor.
+
+    Args:
+        array: Array to encode; float arrays other than float16/float64 are sent as float32
+        encoding: TensorEncoding to use (RAW_BYTES, or REPEATED_FLOAT for old clients)
+    """
+    tensor = weights_transmitting_pb2.WeightTensor()
+    tensor.shape.extend(array.shape)
+    if encoding == weights_transmitting_pb2.REPEATED_FLOAT:
+        tensor.data.extend(np.asarray(array, dtype=np.float32).ravel().tolist())
+        return tensor
+
+    dtype = np.dtype(array.dtype).newbyteorder('<')
+    if dtype not in _WIRE_DTYPES or dtype.kind != 'f':
+        dtype = np.dtype('<f4')
+    tensor.dtype = _WIRE_DTYPES[dtype]
+    tensor.raw_data = np.ascontiguousarray(array, dtype=dtype).tobytes()
+    return tensor
+
+
+def _raw_view(tensor):
+    """Flat view over a tensor's payload in its wire dtype (legacy tensors are rebuilt as float32)"""
+    if tensor.raw_data:
+        return np.frombuffer(tensor.raw_data, dtype=_NUMPY_DTYPES[tensor.dtype])
+    return np.array(tensor.data, dtype=np.float32)
+
+
+def decode_tensor(tensor):
+    """
+    Decode a WeightTensor into a numpy array of its original shape.
+
+    Raw float tensors are returned as a read-only view over the message payload
+    (no copy); legacy tensors are rebuilt from the repeated float field and int8
+    tensors are dequantized to float32. Sparse tensors are scattered into a dense array.
+    """
+    array = _raw_view(tensor)
+    if tensor.raw_data and tensor.dtype == weights_transmitting_pb2.INT8:
+        array = array * np.float32(tensor.scale)
+    if tensor.sparse:
+        dense = np.zeros(int(np.prod(tensor.shape)), dtype=np.float32)
+        dense[np.frombuffer(tensor.indices, dtype=_INDEX_DTYPE)] = array
+        array = dense
+    return array.reshape(tuple(tensor.shape))
+
+
+def check_tensor(tensor):
+    """
+    Check that a WeightTensor's payload matches its shape, without decoding it.
+
+    Dense tensors must hold exactly prod(shape) values; sparse ones as many values as
+    indices, with strictly increasing indices inside the tensor.
+
+    Raises:
+        ValueError: If the payload does not fit the shape
+    """
+    size = int(np.prod(tensor.shape, dtype=np.int64))
+    if tensor.raw_data:
+        dtype = _NUMPY_DTYPES.get(tensor.dtype)
+        if dtype is None or len(tensor.raw_data) % dtype.itemsize:
+            raise ValueError(f"Tensor of shape {list(tensor.shape)} has an invalid raw payload")
+        num_values = len(tensor.raw_data) // dtype.itemsize
+    else:
+        num_values = len(tensor.data)
+    if not tensor.sparse:
+        if num_values != size:
+            raise ValueError(f"Tensor of shape {list(tensor.shape)} holds {num_values} values, expected {size}")
+        return
+    if len(tensor.indices) % _INDEX_DTYPE.itemsize:
+        raise ValueError(f"Sparse tensor of shape {list(tensor.shape)} has an invalid index payload")
+    indices = np.frombuffer(tensor.indices, dtype=_INDEX_DTYPE)
+    if len(indices) != num_values:
+        raise ValueError(f"Sparse tensor has {len(indices)} indices for {num_values} values")
+    if len(indices) and (indices[-1] >= size or np.any(indices[1:] <= indices[:-1])):
+        raise ValueError(f"Sparse tensor of shape {list(tensor.shape)} has unsorted or out-of-range indices")
+
+
+def decode_range(tensor, start, end, out):
+    """
+    Decode the flat entries [start, end) of a WeightTensor into the float32 vector `out`.
+
+    Only that slice is dequantized (int8) or densified (sparse, whose sorted indices are
+    located with searchsorted), so a large tensor never needs a full dense copy. The
+    tensor must have passed check_tensor.
+    """
+    factor = np.float32(tensor.scale) if tensor.raw_data and tensor.dtype == weights_transmitting_pb2.INT8 else None
+    if tensor.sparse:
+        indices = np.frombuffer(tensor.indices, dtype=_INDEX_DTYPE)
+        lo, hi = np.searchsorted(indices, (start, end))
+        values = _raw_view(tensor)[lo:hi]
+        out.fill(0.0)
+        out[indices[lo:hi] - start] = values if factor is None else values * factor
+    elif not tensor.raw_data:
+        # Legacy repeated-float tensor: convert just the slice
+        out[...] = tensor.data[start:end]
+    elif factor is not None:
+        np.multiply(_raw_view(tensor)[start:end], factor, out=out)
+    else:
+        out[...] = _raw_view(tensor)[start:end]
+    return out
+
+
+def accumulate_tensor(tensor, out, weight=1.0, scratch=None):
+    """
+    Add `weight * decode_tensor(tensor)` to `out` in place.
+
+    Dequantization is folded into the scaling, so an int8 tensor goes straight into
+    `out` through `scratch` (same shape as `out`) without a dense float copy. Sparse
+    tensors are scatter-added into `out` (which must be C-contiguous).
+
+    The tensor must have passed check_tensor; every collector checks a whole update before
+    folding any of it in, so a bad tensor cannot leave a partial update behind.
+    """
+    array = _raw_view(tensor)
+    factor = weight
+    if tensor.raw_data and tensor.dtype == weights_transmitting_pb2.INT8:
+        factor *= tensor.scale
+    if tensor.sparse:
+        # check_tensor ensured strictly increasing, in-range indices, so the buffered fancy-index add is exact
+        out.reshape(-1)[np.frombuffer(tensor.indices, dtype=_INDEX_DTYPE)] += array * factor
+        return
+    array = array.reshape(out.shape)
+    if factor == 1.0:
+        np.add(out, array, out=out)
+    else:
+        np.multiply(array, factor, out=scratch)
+        np.add(out, scratch, out=out)
+
+
+def quantize_tensor(array, mode):
+    """
+    Encode a float array as a lossy WeightTensor.
+
+    Args:
+        array: Array to encode
+        mode: 'fp16' (half precision) or 'int8' (per-tensor scale = max|x| / 127)
+
+    Returns:
+        (WeightTensor, dequantized float32 array), the latter for error feedback
+    """
+    if mode == 'fp16':
+        half = np.asarray(array, dtype=np.float16)
+        return encode_tensor(half), half.astype(np.float32)
+    if mode != 'int8':
+        raise ValueError(f"Unknown quantization mode: {mode}")
+
+    max_abs = float(np.max(np.abs(array))) if array.size else 0.0
+    scale = max_abs / 127.0 if max_abs > 0 else 1.0
+    quantized = np.clip(np.rint(array / scale), -127, 127).astype(np.int8)
+    tensor = weights_transmitting_pb2.WeightTensor()
+    tensor.shape.extend(array.shape)
+    tensor.dtype = weights_transmitting_pb2.INT8
+    tensor.scale = scale
+    tensor.raw_data = quantized.tobytes()
+    # Dequantize with the float32 scale stored on the wire, as the aggregator will
+    return tensor, quantized * np.float32(tensor.scale)
+
+
+def convert_weights_to_proto(weights, client_id="unknown", encoding=weights_transmitting_pb2.RAW_BYTES,
+                             round_number=0):
+    """Convert model weights to a protobuf message."""
+    model_weights_msg = weights_transmitting_pb2.ModelWeights()
+    model_weights_msg.client_id = client_id
+    model_weights_msg.round_number = round_number
+    for weight in weights:
+        model_weights_msg.tensors.append(encode_tensor(weight, encoding))
+    return model_weights_msg
+
+
+def proto_to_weights(msg):
+    """Convert protobuf ModelWeights back to numpy arrays."""
+    return [decode_tensor(tensor) for tensor in msg.tensors]
+
+
+def sparsify_tensor(array, fraction):
+    """
+    Encode the top-k largest-magnitude entries of a float array as a sparse WeightTensor.
+
+    Args:
+        array: Array to encode
+        fraction: Share of entries to keep, k = ceil(fraction * size) (at least 1)
+
+    Returns:
+        (WeightTensor, flat indices that were sent)
+    """
+    flat = np.ascontiguousarray(array, dtype=np.float32).reshape(-1)
+    k = min(flat.size, max(1, int(np.ceil(fraction * flat.size))))
+    # argpartition finds the k largest magnitudes without a full sort
+    indices = np.argpartition(np.abs(flat), flat.size - k)[flat.size - k:].astype(_INDEX_DTYPE)
+    # Sorted, so the aggregator can find the entries of a parameter range with searchsorted
+    indices.sort()
+    tensor = weights_transmitting_pb2.WeightTensor()
+    tensor.shape.extend(np.shape(array))
+    tensor.dtype = weights_transmitting_pb2.FLOAT32
+    tensor.sparse = True
+    tensor.indices = indices.tobytes()
+    tensor.raw_data = flat[indices].tobytes()
+    return tensor, indices
+
+
+class DeltaCompressor:
+    """
+    Client-side update compression with error feedback.
+
+    Instead of its weights, the client sends the difference from the global model it
+    started the round with, either quantized to fp16/int8 or reduced to its top-k
+    largest-magnitude entries per tensor. Whatever is not sent (quantization error or
+    the unsent coordinates) is kept as a residual and added to the next round's delta,
+    so it is delayed rather than lost.
+    """
+
+    def __init__(self, mode, topk_fraction=0.01):
+        """
+        Args:
+            mode: 'fp16', 'int8' or 'topk'
+            topk_fraction: Share of each tensor's entries sent in 'topk' mode
+        """
+        if mode not in ('fp16', 'int8', 'topk'):
+            raise ValueError(f"Unknown update compression: {mode}")
+        self.mode = mode
+        self.topk_fraction = topk_fraction
+        self.residuals = None
+
+    def compress(self, weights, base_weights, client_id="unknown", round_number=0):
+        """
+        Build a delta ModelWeights for `weights - base_weights` (plus the carried residual).
+
+        Args:
+            weights: Locally trained weights
+            base_weights: Global model weights the round started from
+        """
+        if self.residuals is None:
+            # One flat buffer for the whole model, used through per-layer views
+            layout = FlatLayout.from_weights(weights)
+            self.residuals = layout.views(layout.allocate(fill=0.0))
+
+        model_weights_msg = weights_transmitting_pb2.ModelWeights()
+        model_weights_msg.client_id = client_id
+        model_weights_msg.round_number = round_number
+        model_weights_msg.is_delta = True
+        for weight, base, residual in zip(weights, base_weights, self.residuals):
+            delta = np.subtract(weight, base, dtype=np.float32)
+            delta += residual
+            if self.mode == 'topk':
+                tensor, indices = sparsify_tensor(delta, self.topk_fraction)
+                residual[...] = delta
+                residual.reshape(-1)[indices] = 0.0
+            else:
+                tensor, sent = quantize_tensor(delta, self.mode)
+                np.subtract(delta, sent, out=residual)
+            model_weights_msg.tensors.append(tensor)
+        return model_weights_msg
@@ -7,6 +7,8 @@
 set -e
 
 NS="federated-learning"
+# aggregator_server.py (thread pool) or aggregator_aio.py (asyncio, for large client counts)
+AGGREGATOR_SCRIPT="${AGGREGATOR_SCRIPT:-aggregator_server.py}"
 
 # ANSI colors for each pod
 C_RESET="\033[0m"
@@ -37,7 +39,7 @@ echo ""
 # --- Start aggregator ---
 echo -e "${C_AGGREGATOR}>>> Starting aggregator server...${C_RESET}"
 AGGREGATOR_POD=$(k3s kubectl get pod -n $NS -l app=federated-aggregator -o jsonpath='{.items[0].metadata.name}')
-k3s kubectl exec -n $NS "$AGGREGATOR_POD" -- bash -c "nohup python3 /app/aggregator_server.py > /tmp/aggregator.log 2>&1 &"
+k3s kubectl exec -n $NS "$AGGREGATOR_POD" -- bash -c "nohup python3 /app/$AGGREGATOR_SCRIPT > /tmp/aggregator.log 2>&1 &"
 echo -e "${C_AGGREGATOR}✅ Aggregator started (pod: $AGGREGATOR_POD)${C_RESET}"
 echo ""
 